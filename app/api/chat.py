@@ -1,20 +1,35 @@
 from fastapi import APIRouter, Depends, HTTPException, Body
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
+import asyncio
+import json
 from app.db.session import get_db
 from app.db import models
 from app.schemas.chat import ChatRequest, ChatResponse
 from uuid import uuid4
-from app.rag.retrieval import retrieve_relevant_chunks, estimate_token_count
+from app.rag.retrieval import retrieve_relevant_chunks, retrieve_relevant_chunks_async, estimate_token_count
+import logging
 import os
 import httpx
 from app.config import OPENAI_API_KEY, OPENAI_MODEL, SYSTEM_PROMPT, OPENAI_API_BASE
+from app.cache.answer_cache import answer_cache
 
 router = APIRouter()
 
-def get_chat_endpoint():
-    if "nvidia" in OPENAI_API_BASE:
-        return f"{OPENAI_API_BASE}"
-    return f"{OPENAI_API_BASE}"
+logger = logging.getLogger(__name__)
+
+# Both providers use the configured base URL directly; resolve it once.
+_LLM_URL = OPENAI_API_BASE
+
+# Shared client so concurrent chats reuse keepalive connections instead of
+# paying a TCP+TLS handshake per request.
+_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30),
+    timeout=httpx.Timeout(connect=10.0, read=60.0, write=10.0, pool=5.0),
+)
+
+async def close_llm_client():
+    await _client.aclose()
 
 async def call_llm(messages, max_tokens=1000):
     headers = {
@@ -29,66 +44,113 @@ async def call_llm(messages, max_tokens=1000):
         "max_tokens": max_tokens,
         "stream": False
     }
-    url = get_chat_endpoint()
-    print(f"[DEBUG] Calling LLM at: {url}")
-    print(f"[DEBUG] Using model: {OPENAI_MODEL}")
-    print(f"[DEBUG] API key present: {bool(OPENAI_API_KEY)}")
-    
-    async with httpx.AsyncClient() as client:
+    logger.debug("Calling LLM at %s with model %s (API key present: %s)",
+                 _LLM_URL, OPENAI_MODEL, bool(OPENAI_API_KEY))
+    try:
+        resp = await _client.post(_LLM_URL, headers=headers, json=body)
+        logger.debug("LLM response status: %s", resp.status_code)
+        resp.raise_for_status()
+        data = resp.json()
+        return data["choices"][0]["message"]["content"]
+    except httpx.TimeoutException:
+        raise Exception("LLM service timeout - request took too long")
+    except httpx.HTTPStatusError as e:
+        raise Exception(f"LLM service HTTP error {e.response.status_code}: {e.response.text}")
+    except Exception as e:
+        raise Exception(f"LLM service error: {str(e)}")
+
+# In-flight LLM calls keyed by answer-cache key, so a burst of identical
+# questions against the same library results in a single upstream request.
+_inflight = {}
+
+async def call_llm_shared(cache_key, messages, max_tokens=1000):
+    task = _inflight.get(cache_key)
+    if task is None:
+        task = asyncio.create_task(call_llm(messages, max_tokens))
+        _inflight[cache_key] = task
+        task.add_done_callback(lambda t: _inflight.pop(cache_key, None))
+    # Shield so one client disconnecting doesn't cancel the shared call
+    return await asyncio.shield(task)
+
+async def call_llm_stream(messages, max_tokens=1000):
+    """Yield answer deltas from a streaming chat completion."""
+    headers = {
+        "Authorization": f"Bearer {OPENAI_API_KEY}",
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream"
+    }
+    body = {
+        "model": OPENAI_MODEL,
+        "messages": messages,
+        "temperature": 0.7,
+        "max_tokens": max_tokens,
+        "stream": True
+    }
+    async with _client.stream("POST", _LLM_URL, headers=headers, json=body) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                break
+            try:
+                delta = json.loads(payload)["choices"][0]["delta"].get("content")
+            except (KeyError, IndexError, ValueError):
+                continue
+            if delta:
+                yield delta
+
+def _sse_event(data: dict) -> str:
+    return f"data: {json.dumps(data)}\n\n"
+
+def _stream_answer(messages, max_tokens, sources, conversation_id, cache_key):
+    """Build an SSE generator that forwards LLM tokens as they arrive."""
+    async def event_stream():
+        answer_parts = []
         try:
-            resp = await client.post(url, headers=headers, json=body, timeout=30.0)
-            print(f"[DEBUG] LLM response status: {resp.status_code}")
-            resp.raise_for_status()
-            data = resp.json()
-            return data["choices"][0]["message"]["content"]
-        except httpx.TimeoutException:
-            raise Exception("LLM service timeout - request took too long")
-        except httpx.HTTPStatusError as e:
-            raise Exception(f"LLM service HTTP error {e.response.status_code}: {e.response.text}")
+            async for delta in call_llm_stream(messages, max_tokens):
+                answer_parts.append(delta)
+                yield _sse_event({"delta": delta})
+        except asyncio.CancelledError:
+            # Client disconnected; closing the generator aborts the
+            # upstream stream as well.
+            raise
         except Exception as e:
-            raise Exception(f"LLM service error: {str(e)}")
+            logger.error("LLM service error: %s", e)
+            yield _sse_event({"error": str(e)})
+            return
+        answer_cache.set(cache_key, ("".join(answer_parts), sources))
+        yield _sse_event({"done": True, "sources": sources, "conversation_id": conversation_id})
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
-@router.post("/{library_id}/chat", response_model=ChatResponse)
-async def chat_with_library(library_id: str, req: ChatRequest = Body(...), db: Session = Depends(get_db)):
-    # Retrieve relevant chunks with response length control
-    metadata_filter = getattr(req, 'metadata_filter', None)
-    document_ids = getattr(req, 'document_ids', None)
-    response_length = getattr(req, 'response_length', 'medium')
-    chunks = retrieve_relevant_chunks(
-        req.question, 
-        library_id, 
-        db, 
-        batch_size=20, 
-        min_relevant=5, 
-        max_batches=25, 
-        metadata_filter=metadata_filter, 
-        document_ids=document_ids,
-        response_length=response_length
-    )
-    if not chunks:
-        return ChatResponse(
-            answer="Sorry, this question is outside the scope of the selected library.",
-            sources=[],
-            conversation_id=req.conversation_id or str(uuid4())
-        )
-    # Diversify context: prefer one chunk per unique toc_title (chapter/section)
-    seen_titles = set()
-    diversified_chunks = []
-    extra_chunks = []
+def build_context(chunks, max_tokens=3500):
+    """Assemble the LLM context from retrieved chunks.
+
+    Diversifies by ToC section, groups chunks by document and enforces the
+    token budget. Returns (context, used_chunks) where used_chunks are the
+    chunks that actually made it into the context.
+    """
+    # Diversify context: prefer one chunk per unique toc_title (chapter/
+    # section). A dict keyed by title gives ordered dedup in one pass;
+    # chunks without a (new) title land in the residue used as filler.
+    by_title = {}
+    residue = []
     for c in chunks:
         toc_title = (c.get('metadata') or {}).get('toc_title')
-        if toc_title and toc_title not in seen_titles:
-            diversified_chunks.append(c)
-            seen_titles.add(toc_title)
+        if toc_title and toc_title not in by_title:
+            by_title[toc_title] = c
         else:
-            extra_chunks.append(c)
-    # Fill up to min_relevant with extra chunks if needed
-    diversified_chunks += extra_chunks[:max(0, 5 - len(diversified_chunks))]
-    # Build enhanced context with better structure
-    MAX_TOKENS = 3500
+            residue.append(c)
+    diversified_chunks = list(by_title.values())
+    # Fill up to min_relevant with residue chunks if needed
+    if len(diversified_chunks) < 5:
+        diversified_chunks.extend(residue[:5 - len(diversified_chunks)])
+
     context_chunks = []
     total_tokens = 0
-    
+    used_chunks = []  # Chunks that actually made it into the context
+
     # Group chunks by document for better organization
     doc_groups = {}
     for c in diversified_chunks:
@@ -96,23 +158,72 @@ async def chat_with_library(library_id: str, req: ChatRequest = Body(...), db: S
         if doc_name not in doc_groups:
             doc_groups[doc_name] = []
         doc_groups[doc_name].append(c)
-    
+
     for doc_name, doc_chunks in doc_groups.items():
-        doc_context = f"=== DOCUMENT: {doc_name} ===\n"
+        # Accumulate parts and join once: repeated string += is quadratic
+        # in the total context length.
+        parts = [f"=== DOCUMENT: {doc_name} ===\n"]
         for c in doc_chunks:
             section_info = f"Section: {(c.get('metadata') or {}).get('toc_title', 'Unknown')}"
             chunk_text = f"[Page {c['page_number']}, {section_info}]\n{c['content']}"
-            chunk_tokens = estimate_token_count(chunk_text)
-            if total_tokens + chunk_tokens > MAX_TOKENS:
+            # Prefer the token count computed at ingest; fall back to the
+            # memoized estimator for chunks predating the column.
+            chunk_tokens = c.get("token_count") or estimate_token_count(chunk_text)
+            if total_tokens + chunk_tokens > max_tokens:
                 break
-            doc_context += chunk_text + "\n\n"
+            parts.append(chunk_text)
+            parts.append("\n\n")
             total_tokens += chunk_tokens
-        context_chunks.append(doc_context)
-        if total_tokens >= MAX_TOKENS:
+            used_chunks.append(c)
+        context_chunks.append("".join(parts))
+        if total_tokens >= max_tokens:
             break
-    
-    context = "\n".join(context_chunks)
-    print(f"[DEBUG] Context sent to LLM (first 1000 chars):\n{context[:1000]}")
+
+    return "\n".join(context_chunks), used_chunks
+
+@router.post("/{library_id}/chat", response_model=ChatResponse)
+async def chat_with_library(library_id: str, req: ChatRequest = Body(...), db: Session = Depends(get_db)):
+    # Retrieve relevant chunks with response length control
+    metadata_filter = getattr(req, 'metadata_filter', None)
+    document_ids = getattr(req, 'document_ids', None)
+    response_length = getattr(req, 'response_length', 'medium')
+    # Retrieval embeds the question and hits FAISS + the DB synchronously;
+    # the async wrapper runs it in a worker thread so the event loop keeps
+    # serving other chats. Sizing (min_relevant, target chunks) comes from
+    # the response-length table inside retrieval; passing an explicit
+    # min_relevant here would override the response_length knob.
+    chunks = await retrieve_relevant_chunks_async(
+        req.question,
+        library_id,
+        db,
+        metadata_filter=metadata_filter,
+        document_ids=document_ids,
+        response_length=response_length
+    )
+    if not chunks:
+        return ChatResponse(
+            answer="Sorry, this question is outside the scope of the selected library.",
+            sources=[],
+            conversation_id=req.conversation_id or str(uuid4())
+        )
+    # Serve repeated questions against an unchanged library from the cache
+    cache_key = answer_cache.make_key(library_id, req.question, response_length, [c["id"] for c in chunks])
+    cached = answer_cache.get(cache_key)
+    if cached is not None:
+        answer, sources = cached
+        conversation_id = req.conversation_id or str(uuid4())
+        if req.stream:
+            # Replay the cached answer as a single SSE event pair
+            async def cached_stream():
+                yield _sse_event({"delta": answer})
+                yield _sse_event({"done": True, "sources": sources, "conversation_id": conversation_id})
+            return StreamingResponse(cached_stream(), media_type="text/event-stream")
+        return ChatResponse(answer=answer, sources=sources, conversation_id=conversation_id)
+    # Context assembly is pure CPU work (grouping, string building, token
+    # budgeting); run it in a worker thread to keep the event loop free.
+    context, used_chunks = await asyncio.to_thread(build_context, chunks, 3500)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Context sent to LLM (first 1000 chars):\n%s", context[:1000])
     
     # Enhanced prompt engineering based on response length
     if response_length == "short":
@@ -129,13 +240,22 @@ async def chat_with_library(library_id: str, req: ChatRequest = Body(...), db: S
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": f"Based on the following context from the documents, please answer the question. If the answer is not in the context, please say so.\n\nContext:\n{context}\n\nQuestion: {req.question}"}
     ]
+    # Cite only chunks that contributed to the context, deduplicated in
+    # first-seen order (dict.fromkeys keeps ordering, unlike set()).
+    sources = list(dict.fromkeys(f"{c['document_name']} (Page {c['page_number']})" for c in used_chunks))
+    conversation_id = req.conversation_id or str(uuid4())
+    if req.stream:
+        return _stream_answer(messages, max_tokens, sources, conversation_id, cache_key)
+    llm_ok = True
     try:
-        answer = await call_llm(messages, max_tokens)
+        answer = await call_llm_shared(cache_key, messages, max_tokens)
     except Exception as e:
-        print(f"[ERROR] LLM service error: {e}")
+        logger.error("LLM service error: %s", e)
         answer = f"I'm having trouble connecting to the AI service. Error: {str(e)}"
-    sources = [f"{c['document_name']} (Page {c['page_number']})" for c in chunks]
-    return ChatResponse(answer=answer, sources=list(set(sources)), conversation_id=req.conversation_id or str(uuid4()))
+        llm_ok = False
+    if llm_ok:
+        answer_cache.set(cache_key, (answer, sources))
+    return ChatResponse(answer=answer, sources=sources, conversation_id=conversation_id)
 
 @router.post("/{library_id}/debug_retrieve", response_model=list)
 def debug_retrieve_chunks(library_id: str, req: ChatRequest = Body(...), db: Session = Depends(get_db), n: int = 10):
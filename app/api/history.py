@@ -1,73 +1,165 @@
-from fastapi import APIRouter, Depends, HTTPException, Body
+from fastapi import APIRouter, Depends, HTTPException, Body, Request, Response
+from sqlalchemy import text, bindparam
 from sqlalchemy.orm import Session, joinedload
 from app.db.session import get_db
 from app.db import models
 from app.schemas.chat import ConversationSchema, ConversationUpdateSchema, ChatMessageSchema
-from typing import List
+from typing import List, Optional
+from datetime import datetime
+from app.utils.etag import make_etag
 
 router = APIRouter()
 debug_router = APIRouter()
 
+# Statements are built once at import so SQLAlchemy's compiled-statement
+# cache is hit on every request instead of re-parsing the SQL strings.
+_LIST_CONV_SQL = text("""
+    SELECT id, library_id, title, created_at, updated_at
+    FROM conversations
+    WHERE library_id = :library_id
+    ORDER BY updated_at DESC, id DESC
+    LIMIT :limit
+""")
+
+_LIST_CONV_CURSOR_SQL = text("""
+    SELECT id, library_id, title, created_at, updated_at
+    FROM conversations
+    WHERE library_id = :library_id
+      AND (updated_at < :cursor_updated_at
+           OR (updated_at = :cursor_updated_at AND id < :cursor_id))
+    ORDER BY updated_at DESC, id DESC
+    LIMIT :limit
+""")
+
+_CONV_STAT_SQL = text("""
+    SELECT
+        (SELECT COUNT(*) FROM conversations WHERE library_id = :library_id) AS conv_count,
+        (SELECT MAX(updated_at) FROM conversations WHERE library_id = :library_id) AS conv_max,
+        (SELECT COUNT(*) FROM chat_messages m
+            JOIN conversations c ON m.conversation_id = c.id
+            WHERE c.library_id = :library_id) AS msg_count
+""")
+
+_MSGS_BY_CONV_SQL = text("""
+    SELECT conversation_id, id, content, role, timestamp, sources
+    FROM chat_messages
+    WHERE conversation_id IN :conv_ids
+    ORDER BY conversation_id, timestamp
+""").bindparams(bindparam("conv_ids", expanding=True))
+
+_CONV_MESSAGES_SQL = text("""
+    SELECT id, content, role, timestamp, sources
+    FROM chat_messages
+    WHERE conversation_id = :conversation_id
+    ORDER BY timestamp
+""")
+
+_GET_CONV_SQL = text("""
+    SELECT
+        c.id, c.library_id, c.title, c.created_at, c.updated_at,
+        m.id as msg_id, m.content, m.role, m.timestamp, m.sources
+    FROM conversations c
+    LEFT JOIN chat_messages m ON c.id = m.conversation_id
+    WHERE c.id = :conversation_id
+    ORDER BY m.timestamp
+""")
+
+_UPDATE_TITLE_SQL = text("""
+    UPDATE conversations
+    SET title = :title, updated_at = CURRENT_TIMESTAMP
+    WHERE id = :conversation_id
+    RETURNING id, library_id, title, created_at, updated_at
+""")
+
+def _split_sources(value):
+    # sources is stored comma-separated; SQLite has no string_to_array, so
+    # the decode stays in Python in this one place.
+    return value.split(",") if value else []
+
 @router.get("/{library_id}/conversations", response_model=List[ConversationSchema])
-def list_conversations(library_id: str, db: Session = Depends(get_db)):
-    # Use raw SQL to avoid session issues
-    from sqlalchemy import text
-    
-    # Get conversations with messages in a single query
-    query = text("""
-        SELECT 
-            c.id, c.library_id, c.title, c.created_at, c.updated_at,
-            m.id as msg_id, m.content, m.role, m.timestamp, m.sources
-        FROM conversations c
-        LEFT JOIN chat_messages m ON c.id = m.conversation_id
-        WHERE c.library_id = :library_id
-        ORDER BY c.updated_at DESC, m.timestamp
-    """)
-    
-    result = db.execute(query, {"library_id": library_id})
-    
-    # Group by conversation
-    conversations = {}
-    for row in result:
-        conv_id = row.id
-        if conv_id not in conversations:
-            conversations[conv_id] = {
-                "id": conv_id,
-                "library_id": row.library_id,
-                "title": row.title,
-                "created_at": row.created_at,
-                "updated_at": row.updated_at,
-                "messages": []
-            }
-        
-        if row.msg_id:  # Only add message if it exists
-            conversations[conv_id]["messages"].append({
-                "id": row.msg_id,
+def list_conversations(
+    library_id: str,
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_db),
+    cursor_updated_at: Optional[datetime] = None,
+    cursor_id: Optional[str] = None,
+    limit: int = 20,
+):
+    # A cheap count/max query yields a strong ETag (parameterized by the
+    # page being requested) so unchanged sidebars revalidate with a 304.
+    stat = db.execute(_CONV_STAT_SQL, {"library_id": library_id}).fetchone()
+    etag = make_etag(library_id, stat.conv_count, stat.conv_max, stat.msg_count,
+                     cursor_updated_at, cursor_id, limit)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+
+    # Keyset pagination on (updated_at, id): the UI sidebar only shows the
+    # most recent page, so never materialize the whole history. The cursor
+    # for the next page is exposed via the X-Next-Cursor header.
+    if cursor_updated_at is not None and cursor_id is not None:
+        conv_query = _LIST_CONV_CURSOR_SQL
+        params = {
+            "library_id": library_id,
+            "cursor_updated_at": cursor_updated_at,
+            "cursor_id": cursor_id,
+            "limit": limit,
+        }
+    else:
+        conv_query = _LIST_CONV_SQL
+        params = {"library_id": library_id, "limit": limit}
+
+    conv_rows = db.execute(conv_query, params).fetchall()
+
+    if len(conv_rows) == limit:
+        last = conv_rows[-1]
+        response.headers["X-Next-Cursor"] = f"{last.updated_at}|{last.id}"
+
+    conversations = {
+        row.id: {
+            "id": row.id,
+            "library_id": row.library_id,
+            "title": row.title,
+            "created_at": row.created_at,
+            "updated_at": row.updated_at,
+            "messages": []
+        }
+        for row in conv_rows
+    }
+
+    if conversations:
+        for row in db.execute(_MSGS_BY_CONV_SQL, {"conv_ids": list(conversations)}):
+            conversations[row.conversation_id]["messages"].append({
+                "id": row.id,
                 "content": row.content,
                 "role": row.role,
                 "timestamp": row.timestamp,
-                "sources": row.sources.split(",") if row.sources else []
+                "sources": _split_sources(row.sources)
             })
-    
+
     return list(conversations.values())
 
+@router.get("/conversations/{conversation_id}/messages", response_model=List[ChatMessageSchema])
+def list_conversation_messages(conversation_id: str, db: Session = Depends(get_db)):
+    """On-demand message loading for a single conversation."""
+    rows = db.execute(_CONV_MESSAGES_SQL, {"conversation_id": conversation_id})
+    return [
+        {
+            "id": row.id,
+            "content": row.content,
+            "role": row.role,
+            "timestamp": row.timestamp,
+            "sources": _split_sources(row.sources)
+        }
+        for row in rows
+    ]
+
 @router.get("/conversations/{conversation_id}", response_model=ConversationSchema)
 def get_conversation(conversation_id: str, db: Session = Depends(get_db)):
-    # Use raw SQL to avoid session issues
-    from sqlalchemy import text
-    
     # Get conversation with messages in a single query
-    query = text("""
-        SELECT 
-            c.id, c.library_id, c.title, c.created_at, c.updated_at,
-            m.id as msg_id, m.content, m.role, m.timestamp, m.sources
-        FROM conversations c
-        LEFT JOIN chat_messages m ON c.id = m.conversation_id
-        WHERE c.id = :conversation_id
-        ORDER BY m.timestamp
-    """)
-    
-    result = db.execute(query, {"conversation_id": conversation_id})
+    result = db.execute(_GET_CONV_SQL, {"conversation_id": conversation_id})
     
     # Group by conversation
     conversation_data = None
@@ -90,7 +182,7 @@ def get_conversation(conversation_id: str, db: Session = Depends(get_db)):
                 "content": row.content,
                 "role": row.role,
                 "timestamp": row.timestamp,
-                "sources": row.sources.split(",") if row.sources else []
+                "sources": _split_sources(row.sources)
             })
     
     if conversation_data is None:
@@ -110,15 +202,22 @@ def delete_conversation(conversation_id: str, db: Session = Depends(get_db)):
 
 @router.patch("/conversations/{conversation_id}", response_model=ConversationSchema)
 def update_conversation_title(conversation_id: str, update: ConversationUpdateSchema = Body(...), db: Session = Depends(get_db)):
-    conversation = db.query(models.Conversation).filter(models.Conversation.id == conversation_id).first()
-    if not conversation:
+    # Single UPDATE ... RETURNING replaces the select/update/refresh/re-join
+    # sequence (four round-trips) with two queries.
+    row = db.execute(_UPDATE_TITLE_SQL, {"title": update.title, "conversation_id": conversation_id}).fetchone()
+    if row is None:
+        db.rollback()
         raise HTTPException(status_code=404, detail="Conversation not found")
-    conversation.title = update.title
     db.commit()
-    db.refresh(conversation)
-    # Return updated conversation with messages
-    # (reuse get_conversation logic for consistency)
-    return get_conversation(conversation_id, db)
+
+    return {
+        "id": row.id,
+        "library_id": row.library_id,
+        "title": row.title,
+        "created_at": row.created_at,
+        "updated_at": row.updated_at,
+        "messages": list_conversation_messages(conversation_id, db)
+    }
 
 @router.post("/{library_id}/conversations", response_model=ConversationSchema)
 def create_conversation(library_id: str, data: dict = Body(...), db: Session = Depends(get_db)):
@@ -1,72 +1,127 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, Response
+from sqlalchemy import text, bindparam
 from sqlalchemy.orm import Session, joinedload
 from app.db.session import get_db
 from app.db import models
-from app.schemas.library import LibrarySchema, LibraryCreate
+from app.schemas.library import LibrarySchema, LibraryListSchema, LibraryCreate
 from typing import List
 from datetime import datetime
+from uuid import uuid4
+import threading
 from app.rag.vector_store import vector_store
+from app.cache.answer_cache import answer_cache
+from app.utils.etag import make_etag
 
 router = APIRouter()
 
-@router.get("/", response_model=List[LibrarySchema])
-def list_libraries(db: Session = Depends(get_db)):
-    # Use raw SQL to avoid session issues
-    from sqlalchemy import text
-    
-    # Get libraries with documents and chunks in a single query
-    query = text("""
-        SELECT 
-            l.id, l.name, l.description, l.created_at, l.tags,
-            d.id as doc_id, d.name as doc_name, d.upload_date, d.library_id, d.toc,
-            c.id as chunk_id, c.content, c.page_number, c.chunk_index
-        FROM libraries l
-        LEFT JOIN pdf_documents d ON l.id = d.library_id
-        LEFT JOIN document_chunks c ON d.id = c.document_id
-        ORDER BY l.created_at DESC, d.upload_date DESC, c.page_number, c.chunk_index
-    """)
-    
-    result = db.execute(query)
-    
-    # Group by library and document
-    libraries = {}
-    for row in result:
-        lib_id = row.id
-        if lib_id not in libraries:
-            libraries[lib_id] = {
-                "id": lib_id,
-                "name": row.name,
-                "description": row.description,
-                "created_at": row.created_at,
-                "tags": row.tags,
-                "documents": {}
-            }
-        
-        if row.doc_id:  # Only add document if it exists
-            doc_id = row.doc_id
-            if doc_id not in libraries[lib_id]["documents"]:
-                libraries[lib_id]["documents"][doc_id] = {
-                    "id": doc_id,
-                    "name": row.doc_name,
-                    "upload_date": row.upload_date,
-                    "library_id": row.library_id,
-                    "toc": row.toc,
-                    "chunks": []
-                }
-            
-            if row.chunk_id:  # Only add chunk if it exists
-                libraries[lib_id]["documents"][doc_id]["chunks"].append({
-                    "id": row.chunk_id,
-                    "content": row.content,
-                    "page_number": row.page_number,
-                    "chunk_index": row.chunk_index
-                })
-    
-    # Convert documents dict to list
-    for lib in libraries.values():
-        lib["documents"] = list(lib["documents"].values())
-    
-    return list(libraries.values())
+# Statements are built once at import so SQLAlchemy's compiled-statement
+# cache is hit on every request instead of re-parsing the SQL strings.
+_LIST_LIBS_SQL = text("""
+    SELECT id, name, description, created_at, tags
+    FROM libraries
+    ORDER BY created_at DESC
+""")
+
+_GET_LIB_SQL = text("""
+    SELECT id, name, description, created_at, tags
+    FROM libraries
+    WHERE id = :library_id
+""")
+
+_LIBS_STAT_SQL = text("""
+    SELECT
+        (SELECT COUNT(*) FROM libraries) AS lib_count,
+        (SELECT MAX(created_at) FROM libraries) AS lib_max,
+        (SELECT COUNT(*) FROM pdf_documents) AS doc_count,
+        (SELECT MAX(upload_date) FROM pdf_documents) AS doc_max
+""")
+
+_LIB_STAT_SQL = text("""
+    SELECT
+        (SELECT COUNT(*) FROM pdf_documents WHERE library_id = :library_id) AS doc_count,
+        (SELECT MAX(upload_date) FROM pdf_documents WHERE library_id = :library_id) AS doc_max,
+        (SELECT COUNT(*) FROM document_chunks c
+            JOIN pdf_documents d ON c.document_id = d.id
+            WHERE d.library_id = :library_id) AS chunk_count
+""")
+
+_DOCS_BY_LIBS_SQL = text("""
+    SELECT id, name, upload_date, library_id, toc
+    FROM pdf_documents
+    WHERE library_id IN :lib_ids
+    ORDER BY upload_date DESC
+""").bindparams(bindparam("lib_ids", expanding=True))
+
+_CHUNKS_BY_DOCS_SQL = text("""
+    SELECT id, document_id, content, page_number, chunk_index
+    FROM document_chunks
+    WHERE document_id IN :doc_ids
+    ORDER BY document_id, page_number, chunk_index
+""").bindparams(bindparam("doc_ids", expanding=True))
+
+def _fetch_documents_with_chunks(db: Session, lib_ids: list, include_chunks: bool = True):
+    """Fetch documents (optionally with their chunks) for a set of libraries
+    with focused queries, avoiding the Cartesian join that duplicates library
+    and document columns on every chunk row."""
+    docs_by_lib = {lib_id: [] for lib_id in lib_ids}
+    if not lib_ids:
+        return docs_by_lib
+
+    doc_rows = db.execute(_DOCS_BY_LIBS_SQL, {"lib_ids": lib_ids}).fetchall()
+
+    chunks_by_doc = {}
+    doc_ids = [row.id for row in doc_rows]
+    if doc_ids and include_chunks:
+        for row in db.execute(_CHUNKS_BY_DOCS_SQL, {"doc_ids": doc_ids}):
+            chunks_by_doc.setdefault(row.document_id, []).append({
+                "id": row.id,
+                "content": row.content,
+                "page_number": row.page_number,
+                "chunk_index": row.chunk_index
+            })
+
+    for row in doc_rows:
+        docs_by_lib[row.library_id].append({
+            "id": row.id,
+            "name": row.name,
+            "upload_date": row.upload_date,
+            "library_id": row.library_id,
+            "toc": row.toc,
+            "chunks": chunks_by_doc.get(row.id, [])
+        })
+    return docs_by_lib
+
+@router.get("/", response_model=List[LibraryListSchema])
+def list_libraries(request: Request, response: Response, db: Session = Depends(get_db)):
+    # A cheap count/max query yields a strong ETag, so unchanged views are
+    # answered with a 304 before the full payload is assembled. The summed
+    # mutation generation covers in-place edits (document rename, tag
+    # update) that move no row count or timestamp.
+    stat = db.execute(_LIBS_STAT_SQL).fetchone()
+    etag = make_etag(stat.lib_count, stat.lib_max, stat.doc_count, stat.doc_max,
+                     answer_cache.get_total_generation())
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+
+    lib_rows = db.execute(_LIST_LIBS_SQL).fetchall()
+
+    # The list view only needs document metadata; chunk bodies are served
+    # by the paginated chunks endpoint.
+    docs_by_lib = _fetch_documents_with_chunks(db, [row.id for row in lib_rows], include_chunks=False)
+
+    return [
+        {
+            "id": row.id,
+            "name": row.name,
+            "description": row.description,
+            "created_at": row.created_at,
+            "tags": row.tags,
+            "documents": docs_by_lib.get(row.id, [])
+        }
+        for row in lib_rows
+    ]
 
 @router.post("/", response_model=LibrarySchema)
 def create_library(library: LibraryCreate, db: Session = Depends(get_db)):
@@ -88,81 +143,76 @@ def delete_library(library_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Library not found")
     db.delete(library)
     db.commit()
+    # Drop the library's FAISS shard (memory and files) so its vectors are
+    # gone immediately and cannot be re-loaded on the next startup.
+    vector_store.remove_library(library_id)
+    answer_cache.bump_generation(library_id)
     return {"detail": "Library deleted"}
 
 @router.get("/{library_id}", response_model=LibrarySchema)
-def get_library(library_id: str, db: Session = Depends(get_db)):
-    # Use raw SQL to avoid session issues
-    from sqlalchemy import text
-    
-    # Get library with documents and chunks in a single query
-    query = text("""
-        SELECT 
-            l.id, l.name, l.description, l.created_at, l.tags,
-            d.id as doc_id, d.name as doc_name, d.upload_date, d.library_id, d.toc,
-            c.id as chunk_id, c.content, c.page_number, c.chunk_index
-        FROM libraries l
-        LEFT JOIN pdf_documents d ON l.id = d.library_id
-        LEFT JOIN document_chunks c ON d.id = c.document_id
-        WHERE l.id = :library_id
-        ORDER BY d.upload_date DESC, c.page_number, c.chunk_index
-    """)
-    
-    result = db.execute(query, {"library_id": library_id})
-    
-    # Group by document
-    documents = {}
-    library_data = None
-    
-    for row in result:
-        if library_data is None:
-            library_data = {
-                "id": row.id,
-                "name": row.name,
-                "description": row.description,
-                "created_at": row.created_at,
-                "tags": row.tags,
-                "documents": {}
-            }
-        
-        if row.doc_id:  # Only add document if it exists
-            doc_id = row.doc_id
-            if doc_id not in documents:
-                documents[doc_id] = {
-                    "id": doc_id,
-                    "name": row.doc_name,
-                    "upload_date": row.upload_date,
-                    "library_id": row.library_id,
-                    "toc": row.toc,
-                    "chunks": []
-                }
-            
-            if row.chunk_id:  # Only add chunk if it exists
-                documents[doc_id]["chunks"].append({
-                    "id": row.chunk_id,
-                    "content": row.content,
-                    "page_number": row.page_number,
-                    "chunk_index": row.chunk_index
-                })
-    
-    if library_data is None:
+def get_library(library_id: str, request: Request, response: Response, db: Session = Depends(get_db)):
+    lib_row = db.execute(_GET_LIB_SQL, {"library_id": library_id}).fetchone()
+
+    if lib_row is None:
         raise HTTPException(status_code=404, detail="Library not found")
-    
-    library_data["documents"] = list(documents.values())
-    return library_data
 
-@router.post("/rebuild-index")
-def rebuild_vector_index(db: Session = Depends(get_db)):
-    """Manually rebuild the FAISS vector index from the database"""
+    stat = db.execute(_LIB_STAT_SQL, {"library_id": library_id}).fetchone()
+    # The generation covers in-place edits (rename, tags) that the
+    # count/max statistics cannot see.
+    etag = make_etag(library_id, lib_row.created_at, stat.doc_count, stat.doc_max,
+                     stat.chunk_count, answer_cache.get_generation(library_id))
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+
+    docs_by_lib = _fetch_documents_with_chunks(db, [lib_row.id])
+
+    return {
+        "id": lib_row.id,
+        "name": lib_row.name,
+        "description": lib_row.description,
+        "created_at": lib_row.created_at,
+        "tags": lib_row.tags,
+        "documents": docs_by_lib.get(lib_row.id, [])
+    }
+
+# A full rebuild can take minutes on large libraries, so it runs as a
+# background task. The lock prevents concurrent rebuilds; job states live
+# in-process, matching the in-process vector store.
+_rebuild_lock = threading.Lock()
+_rebuild_jobs = {}  # job_id -> {"status": ..., "stats"/"error": ...}
+
+def _run_rebuild(job_id: str):
+    from app.db.session import SessionLocal
+
+    db = SessionLocal()
     try:
         vector_store.rebuild_from_database(db)
-        stats = vector_store.get_stats()
-        return {
-            "message": "Vector index rebuilt successfully",
-            "stats": stats
-        }
+        _rebuild_jobs[job_id] = {"status": "completed", "stats": vector_store.get_stats()}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to rebuild index: {str(e)}")
+        _rebuild_jobs[job_id] = {"status": "failed", "error": str(e)}
+    finally:
+        db.close()
+        _rebuild_lock.release()
+
+@router.post("/rebuild-index", status_code=202)
+def rebuild_vector_index(background_tasks: BackgroundTasks):
+    """Start a FAISS vector index rebuild in the background"""
+    if not _rebuild_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="An index rebuild is already in progress")
+    job_id = str(uuid4())
+    _rebuild_jobs[job_id] = {"status": "running"}
+    background_tasks.add_task(_run_rebuild, job_id)
+    return {"message": "Vector index rebuild started", "job_id": job_id}
+
+@router.get("/rebuild-index/{job_id}")
+def get_rebuild_status(job_id: str):
+    """Poll the status of a background index rebuild"""
+    job = _rebuild_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Rebuild job not found")
+    return {"job_id": job_id, **job}
 
 @router.get("/vector-store/stats")
 def get_vector_store_stats():
@@ -1,130 +1,265 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Response
+from fastapi import APIRouter, Depends, Header, HTTPException, UploadFile, File, Response
 from fastapi.responses import FileResponse
+from sqlalchemy import text, insert
 from sqlalchemy.orm import Session, joinedload
+from uuid import uuid4
+from collections import defaultdict
 from app.db.session import get_db
 from app.db import models
-from app.schemas.pdf import PDFDocumentSchema
+from app.schemas.pdf import PDFDocumentSchema, DocumentChunkSchema
 from typing import List
 from datetime import datetime
+import logging
+import numpy as np
 import os
 import tempfile
 from app.rag.pdf_parser import parse_pdf_and_chunk, extract_toc_from_pdf
 from app.rag.embedder import embed_texts
+from app.rag.retrieval import estimate_token_count
 from app.rag.vector_store import vector_store
+from app.cache.answer_cache import answer_cache
 import PyPDF2
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
 MAX_PDF_SIZE_MB = 20
 
+# Statements are built once at import so SQLAlchemy's compiled-statement
+# cache is hit on every request instead of re-parsing the SQL strings.
+_LIST_DOCS_SQL = text("""
+    SELECT
+        d.id, d.name, d.upload_date, d.library_id, d.toc, d.tags,
+        c.id as chunk_id, c.content, c.page_number, c.chunk_index
+    FROM pdf_documents d
+    LEFT JOIN document_chunks c ON d.id = c.document_id
+    WHERE d.library_id = :library_id
+    ORDER BY d.upload_date DESC, c.page_number, c.chunk_index
+""")
+
+_DOC_EXISTS_SQL = text("""
+    SELECT id FROM pdf_documents
+    WHERE id = :document_id AND library_id = :library_id
+""")
+
+_CHUNK_PAGE_SQL = text("""
+    SELECT id, content, page_number, chunk_index
+    FROM document_chunks
+    WHERE document_id = :document_id
+      AND (page_number > :last_page
+           OR (page_number = :last_page AND chunk_index > :last_idx))
+    ORDER BY page_number, chunk_index
+    LIMIT :limit
+""")
+
+# Table chunks carry is_table in their metadata; text chunks omit the key,
+# so json_extract returning NULL distinguishes the two inside SQLite.
+_DOC_STATS_SQL = text("""
+    SELECT
+        COUNT(*) AS total_chunks,
+        COALESCE(MAX(page_number), 0) AS total_pages,
+        SUM(CASE WHEN json_extract(chunk_metadata, '$.is_table') IS NULL THEN 1 ELSE 0 END) AS text_chunks,
+        SUM(CASE WHEN json_extract(chunk_metadata, '$.is_table') IS NOT NULL THEN 1 ELSE 0 END) AS table_chunks,
+        COALESCE(SUM(CASE WHEN json_extract(chunk_metadata, '$.is_table') IS NULL
+                          THEN LENGTH(content) ELSE 0 END), 0) AS total_text_length,
+        COUNT(DISTINCT json_extract(chunk_metadata, '$.heading')) AS unique_headings,
+        COUNT(DISTINCT json_extract(chunk_metadata, '$.toc_title')) AS unique_toc_sections
+    FROM document_chunks
+    WHERE document_id = :document_id
+""")
+
 @router.get("/{library_id}/documents", response_model=List[PDFDocumentSchema])
 def list_documents(library_id: str, db: Session = Depends(get_db)):
-    # Use a more direct approach to avoid session issues
-    from sqlalchemy import text
-    
-    # Get documents with chunks in a single query
-    query = text("""
-        SELECT 
-            d.id, d.name, d.upload_date, d.library_id, d.toc, d.tags,
-            c.id as chunk_id, c.content, c.page_number, c.chunk_index
-        FROM pdf_documents d
-        LEFT JOIN document_chunks c ON d.id = c.document_id
-        WHERE d.library_id = :library_id
-        ORDER BY d.upload_date DESC, c.page_number, c.chunk_index
-    """)
-    
-    result = db.execute(query, {"library_id": library_id})
-    
-    # Group by document
+    result = db.execute(_LIST_DOCS_SQL, {"library_id": library_id}).fetchall()
+
+    # One streaming pass with tuple unpacking: document metadata goes into a
+    # plain dict (last write wins, insertion order preserved) and chunks into
+    # a defaultdict, so there is no membership branch per row and only one
+    # dict is built per chunk.
     documents = {}
-    for row in result:
-        doc_id = row.id
-        if doc_id not in documents:
-            documents[doc_id] = {
-                "id": doc_id,
-                "name": row.name,
-                "upload_date": row.upload_date,
-                "library_id": row.library_id,
-                "toc": row.toc,
-                "tags": row.tags,
-                "chunks": []
-            }
-        
-        if row.chunk_id:  # Only add chunk if it exists
-            documents[doc_id]["chunks"].append({
-                "id": row.chunk_id,
-                "content": row.content,
-                "page_number": row.page_number,
-                "chunk_index": row.chunk_index
+    chunks_by_doc = defaultdict(list)
+    for doc_id, name, upload_date, lib_id, toc, tags, chunk_id, content, page, idx in result:
+        documents[doc_id] = (name, upload_date, lib_id, toc, tags)
+        if chunk_id:
+            chunks_by_doc[doc_id].append({
+                "id": chunk_id,
+                "content": content,
+                "page_number": page,
+                "chunk_index": idx
             })
-    
-    return list(documents.values())
+
+    return [
+        {
+            "id": doc_id,
+            "name": name,
+            "upload_date": upload_date,
+            "library_id": lib_id,
+            "toc": toc,
+            "tags": tags,
+            "chunks": chunks_by_doc.get(doc_id, [])
+        }
+        for doc_id, (name, upload_date, lib_id, toc, tags) in documents.items()
+    ]
+
+@router.get("/{library_id}/documents/{document_id}/chunks", response_model=List[DocumentChunkSchema])
+def list_document_chunks(
+    library_id: str,
+    document_id: str,
+    db: Session = Depends(get_db),
+    last_page: int = -1,
+    last_idx: int = -1,
+    limit: int = 100,
+):
+    """Keyset-paginated chunk listing: pass the last seen (page_number,
+    chunk_index) as the cursor for the next page."""
+    doc = db.execute(_DOC_EXISTS_SQL, {"document_id": document_id, "library_id": library_id}).fetchone()
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    rows = db.execute(_CHUNK_PAGE_SQL, {
+        "document_id": document_id,
+        "last_page": last_page,
+        "last_idx": last_idx,
+        "limit": limit,
+    })
+    return [
+        {
+            "id": row.id,
+            "content": row.content,
+            "page_number": row.page_number,
+            "chunk_index": row.chunk_index
+        }
+        for row in rows
+    ]
+
+@router.post("/bulk-ingest/begin")
+def begin_bulk_ingest():
+    """Kept for compatibility: deferral is opted into per upload via the
+    X-Bulk-Ingest header, so there is no global state to arm here."""
+    return {"detail": "Bulk ingest started"}
+
+@router.post("/bulk-ingest/end")
+def end_bulk_ingest():
+    """Fold embeddings deferred by X-Bulk-Ingest uploads into the index."""
+    added = vector_store.end_bulk()
+    return {"detail": "Bulk ingest finished", "embeddings_added": added}
 
 @router.post("/{library_id}/documents", response_model=PDFDocumentSchema)
-def upload_document(library_id: str, file: UploadFile = File(...), db: Session = Depends(get_db)):
+def upload_document(
+    library_id: str,
+    file: UploadFile = File(...),
+    x_bulk_ingest: str = Header(default=None),
+    db: Session = Depends(get_db),
+):
     # Validate file type
     if file.content_type != "application/pdf" or not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF files are supported.")
-    # Validate file size
-    file.file.seek(0, os.SEEK_END)
-    size_mb = file.file.tell() / (1024 * 1024)
-    file.file.seek(0)
-    if size_mb > MAX_PDF_SIZE_MB:
-        raise HTTPException(status_code=400, detail=f"PDF file too large (>{MAX_PDF_SIZE_MB}MB).")
     tmp_path = None
     try:
-        # Save file to temp
+        # Stream the upload to a temp file through a 1 MB buffer, counting
+        # bytes as we copy: the PDF is never held in memory and oversized
+        # files abort as soon as they cross the limit.
+        size = 0
         with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            tmp.write(file.file.read())
             tmp_path = tmp.name
+            while True:
+                buf = file.file.read(1024 * 1024)
+                if not buf:
+                    break
+                size += len(buf)
+                if size > MAX_PDF_SIZE_MB * 1024 * 1024:
+                    raise HTTPException(status_code=400, detail=f"PDF file too large (>{MAX_PDF_SIZE_MB}MB).")
+                tmp.write(buf)
         # Extract ToC
         toc = extract_toc_from_pdf(tmp_path)
-        print(f"[DEBUG] Extracted ToC: {toc}")
+        logger.debug("Extracted ToC: %s", toc)
         # Parse and chunk using ToC and heading detection
         chunks = parse_pdf_and_chunk(tmp_path, toc)
-        print(f"[DEBUG] Parsed {len(chunks)} chunks from PDF '{file.filename}'")
-        for i, c in enumerate(chunks[:3]):
-            print(f"[DEBUG] Chunk {i}: {c}")
+        logger.debug("Parsed %d chunks from PDF '%s'", len(chunks), file.filename)
+        if logger.isEnabledFor(logging.DEBUG):
+            for i, c in enumerate(chunks[:3]):
+                logger.debug("Chunk %d: %s", i, c)
         if not chunks:
             raise HTTPException(status_code=400, detail="No text could be extracted from the PDF.")
         chunk_texts = [c[0] for c in chunks]
-        # Embed
-        embeddings = embed_texts(chunk_texts) if chunk_texts else []
-        print(f"[DEBUG] Generated {len(embeddings)} embeddings for PDF '{file.filename}'")
-        # Create PDFDocument
+        # Embed (returns an ndarray, one row per chunk)
+        embeddings = embed_texts(chunk_texts)
+        logger.debug("Generated %d embeddings for PDF '%s'", len(embeddings), file.filename)
+        # Create PDFDocument. The id and upload_date are generated client-side
+        # anyway; keeping them in locals means nothing below touches the ORM
+        # instance after commit (expire_on_commit would re-SELECT it on every
+        # attribute access otherwise).
+        doc_id = str(uuid4())
+        doc_name = file.filename
+        upload_date = datetime.utcnow()
         db_doc = models.PDFDocument(
-            name=file.filename,
-            upload_date=datetime.utcnow(),
+            id=doc_id,
+            name=doc_name,
+            upload_date=upload_date,
             library_id=library_id,
             toc=toc,
             tags=""  # Default empty tags
         )
         db.add(db_doc)
         db.commit()
-        db.refresh(db_doc)
-        # Add chunks to DB and vector store
-        meta = []
-        for (chunk_text, page_number, chunk_index, metadata), emb in zip(chunks, embeddings):
-            db_chunk = models.DocumentChunk(
-                content=chunk_text,
-                page_number=page_number,
-                chunk_index=chunk_index,
-                document_id=db_doc.id,
-                chunk_metadata=metadata
-            )
-            db.add(db_chunk)
+        # Add chunks to DB in one batched insert: per-chunk add/commit/refresh
+        # costs N round-trips and N fsyncs. Pre-generating the ids lets the
+        # vector-store metadata be assembled without any refresh.
+        chunk_ids = [str(uuid4()) for _ in chunks]
+        rows = [
+            {
+                "id": chunk_id,
+                "content": chunk_text,
+                "page_number": page_number,
+                "chunk_index": chunk_index,
+                "document_id": doc_id,
+                "chunk_metadata": metadata,
+                "token_count": estimate_token_count(chunk_text)
+            }
+            for chunk_id, (chunk_text, page_number, chunk_index, metadata) in zip(chunk_ids, chunks)
+        ]
+        meta = [
+            (library_id, doc_id, doc_name, chunk_id, page_number, chunk_index)
+            for chunk_id, (_text, page_number, chunk_index, _meta) in zip(chunk_ids, chunks)
+        ]
+        if rows:
+            db.execute(insert(models.DocumentChunk), rows)
             db.commit()
-            db.refresh(db_chunk)
-            meta.append((library_id, db_doc.id, db_chunk.id, page_number, chunk_index))
-        if embeddings:
-            vector_store.add_embeddings(embeddings, meta)
-            print(f"[DEBUG] Added {len(embeddings)} embeddings to vector store for PDF '{file.filename}'")
-        return db_doc
+        if len(embeddings):
+            # Hand FAISS a contiguous fp32 buffer so add() works on it
+            # directly instead of converting a temporary copy. Uploads that
+            # send X-Bulk-Ingest defer their index add until /bulk-ingest/end
+            # folds the whole batch in with one add and one save; uploads
+            # without the header are indexed immediately.
+            vector_store.add_embeddings(
+                np.ascontiguousarray(embeddings, dtype=np.float32), meta,
+                defer=(x_bulk_ingest == "1"))
+            logger.debug("Added %d embeddings to vector store for PDF '%s'", len(embeddings), file.filename)
+        answer_cache.bump_generation(library_id)
+        # Build the response from the values already in hand: returning the
+        # ORM object would expire on the commits above and re-SELECT the
+        # document plus every chunk during serialization.
+        return {
+            "id": doc_id,
+            "name": doc_name,
+            "upload_date": upload_date,
+            "tags": "",
+            "chunks": [
+                {
+                    "id": row["id"],
+                    "content": row["content"],
+                    "page_number": row["page_number"],
+                    "chunk_index": row["chunk_index"],
+                }
+                for row in rows
+            ],
+        }
     except HTTPException:
-        print(f"[ERROR] HTTPException during PDF upload for '{file.filename}'")
+        logger.error("HTTPException during PDF upload for '%s'", file.filename)
         raise
     except Exception as e:
-        print(f"[ERROR] PDF processing error for '{file.filename}': {e}")
+        logger.error("PDF processing error for '%s': %s", file.filename, e)
         raise HTTPException(status_code=500, detail="Failed to process PDF. Please try another file or check the PDF content.")
     finally:
         if tmp_path and os.path.exists(tmp_path):
@@ -138,11 +273,15 @@ def update_document(library_id: str, document_id: str, update_data: dict, db: Se
     
     if "name" in update_data:
         doc.name = update_data["name"]
+        # The name is cached in the FAISS shard metadata for retrieval;
+        # rewrite it there too so old names are never served.
+        vector_store.rename_document(library_id, document_id, update_data["name"])
     if "tags" in update_data:
         doc.tags = update_data["tags"]
     
     db.commit()
     db.refresh(doc)
+    answer_cache.bump_generation(library_id)
     return {"detail": "Document updated", "document": doc}
 
 @router.delete("/{library_id}/documents/{document_id}")
@@ -152,6 +291,7 @@ def delete_document(library_id: str, document_id: str, db: Session = Depends(get
         raise HTTPException(status_code=404, detail="Document not found")
     db.delete(doc)
     db.commit()
+    answer_cache.bump_generation(library_id)
     return {"detail": "Document deleted"}
 
 @router.get("/{library_id}/pdfs/{document_id}/processing-stats")
@@ -164,51 +304,32 @@ def get_document_processing_stats(library_id: str, document_id: str, db: Session
     
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
-    
-    # Get all chunks for this document
-    chunks = db.query(models.DocumentChunk).filter(
-        models.DocumentChunk.document_id == document_id
-    ).all()
-    
-    # Calculate statistics
-    total_chunks = len(chunks)
-    total_pages = max([chunk.page_number for chunk in chunks]) if chunks else 0
-    
-    # Count tables and other metadata
-    table_chunks = [c for c in chunks if c.chunk_metadata and c.chunk_metadata.get('is_table')]
-    text_chunks = [c for c in chunks if not (c.chunk_metadata and c.chunk_metadata.get('is_table'))]
-    
-    # Calculate text statistics
-    total_text_length = sum(len(c.content) for c in text_chunks)
-    avg_chunk_length = total_text_length / len(text_chunks) if text_chunks else 0
-    
-    # Get unique sections/headings
-    headings = set()
-    toc_titles = set()
-    for chunk in chunks:
-        if chunk.chunk_metadata:
-            if chunk.chunk_metadata.get('heading'):
-                headings.add(chunk.chunk_metadata['heading'])
-            if chunk.chunk_metadata.get('toc_title'):
-                toc_titles.add(chunk.chunk_metadata['toc_title'])
-    
+
+    # Aggregate in SQL instead of materialising every chunk row in Python.
+    agg = db.execute(_DOC_STATS_SQL, {"document_id": document_id}).fetchone()
+
+    text_chunks = agg.text_chunks or 0
+    table_chunks = agg.table_chunks or 0
+    total_text_length = agg.total_text_length or 0
+    avg_chunk_length = total_text_length / text_chunks if text_chunks else 0
+
     stats = {
         "document_id": document_id,
         "name": doc.name,
-        "total_pages": total_pages,
-        "total_chunks": total_chunks,
-        "text_chunks": len(text_chunks),
-        "table_chunks": len(table_chunks),
+        "total_pages": agg.total_pages,
+        "total_chunks": agg.total_chunks,
+        "text_chunks": text_chunks,
+        "table_chunks": table_chunks,
         "total_text_length": total_text_length,
         "average_chunk_length": round(avg_chunk_length, 2),
-        "unique_headings": len(headings),
-        "unique_toc_sections": len(toc_titles),
+        "unique_headings": agg.unique_headings,
+        "unique_toc_sections": agg.unique_toc_sections,
         "processing_quality": {
             "has_toc": bool(doc.toc),
             "has_tags": bool(doc.tags),
             "text_extraction_success": total_text_length > 0,
-            "table_extraction_success": len(table_chunks) > 0
+            "table_extraction_success": table_chunks > 0
         }
     }
-    
+
     return stats
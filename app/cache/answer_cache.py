@@ -0,0 +1,69 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+class AnswerCache:
+    """Thread-safe TTL + LRU cache for LLM answers.
+
+    Keys include a per-library generation counter that is bumped whenever a
+    library or its documents are mutated, so stale answers are never served
+    after an upload/delete.
+    """
+
+    def __init__(self, maxsize: int = 2000, ttl: float = 600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._generations = {}  # library_id -> int
+
+    def bump_generation(self, library_id: str):
+        """Invalidate cached answers for a library after a mutation."""
+        with self._lock:
+            self._generations[library_id] = self._generations.get(library_id, 0) + 1
+
+    def get_generation(self, library_id: str) -> int:
+        """Current mutation generation for a library, for use in other
+        cache keys that must invalidate on library changes."""
+        with self._lock:
+            return self._generations.get(library_id, 0)
+
+    def get_total_generation(self) -> int:
+        """Sum of all library generations, for cache keys over cross-library
+        views that must move on any mutation."""
+        with self._lock:
+            return sum(self._generations.values())
+
+    def make_key(self, library_id: str, question: str, response_length: str, chunk_ids) -> str:
+        with self._lock:
+            generation = self._generations.get(library_id, 0)
+        raw = "|".join([
+            library_id,
+            str(generation),
+            question.lower().strip(),
+            response_length,
+            ",".join(sorted(chunk_ids)),
+        ])
+        return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+answer_cache = AnswerCache()
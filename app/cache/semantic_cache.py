@@ -0,0 +1,75 @@
+import json
+import threading
+import faiss
+import numpy as np
+from collections import OrderedDict
+
+class SemanticCache:
+    """Thread-safe cosine-similarity cache for retrieval results.
+
+    Question embeddings are already L2-normalized, so inner product equals
+    cosine similarity: a new question matching a cached one above the
+    threshold reuses its chunk list and skips the FAISS search and DB fetch
+    entirely. Entries are bucketed by a caller-built signature (library,
+    generation, filters), so differently-scoped queries never cross and
+    mutated libraries leave their stale buckets unreachable. The bucket
+    count itself is LRU-bounded: every mutation or filter variation mints a
+    new signature, and without eviction the stranded buckets (payloads hold
+    full chunk bodies) would accumulate for the life of the process.
+    """
+
+    def __init__(self, dim: int = 384, cap: int = 1024, threshold: float = 0.97, max_buckets: int = 64):
+        self.dim = dim
+        self.cap = cap  # per-bucket entry limit
+        self.max_buckets = max_buckets
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # signature -> {"index", "embs", "payloads"}
+
+    @staticmethod
+    def make_signature(library_id, generation, response_length, metadata_filter, document_ids):
+        return (
+            library_id,
+            generation,
+            response_length,
+            tuple(sorted(document_ids or ())),
+            # Canonical JSON rather than a frozenset of items: filter values
+            # are arbitrary (lists, dicts) and need not be hashable.
+            json.dumps(metadata_filter or {}, sort_keys=True, default=str),
+        )
+
+    def get(self, signature, q_emb):
+        with self._lock:
+            bucket = self._buckets.get(signature)
+            if not bucket or not bucket["payloads"]:
+                return None
+            self._buckets.move_to_end(signature)
+            D, I = bucket["index"].search(np.asarray(q_emb, dtype='float32').reshape(1, -1), 1)
+            if D[0][0] >= self.threshold:
+                return bucket["payloads"][I[0][0]]
+        return None
+
+    def put(self, signature, q_emb, payload):
+        vec = np.asarray(q_emb, dtype='float32').reshape(1, -1)
+        with self._lock:
+            bucket = self._buckets.get(signature)
+            if bucket is None:
+                bucket = {"index": faiss.IndexFlatIP(self.dim), "embs": [], "payloads": []}
+                self._buckets[signature] = bucket
+                while len(self._buckets) > self.max_buckets:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(signature)
+            if len(bucket["payloads"]) >= self.cap:
+                # Drop the older half and rebuild the bucket's index; flat
+                # indexes have no cheap single-row removal.
+                half = self.cap // 2
+                bucket["embs"] = bucket["embs"][half:]
+                bucket["payloads"] = bucket["payloads"][half:]
+                bucket["index"] = faiss.IndexFlatIP(self.dim)
+                bucket["index"].add(np.vstack(bucket["embs"]))
+            bucket["index"].add(vec)
+            bucket["embs"].append(vec[0])
+            bucket["payloads"].append(payload)
+
+semantic_cache = SemanticCache()
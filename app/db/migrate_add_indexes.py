@@ -0,0 +1,43 @@
+import sqlite3
+import os
+
+# Composite indexes backing the hot query shapes:
+# - conversations filtered by library_id, ordered by updated_at DESC
+# - chat_messages filtered by conversation_id, ordered by timestamp
+# - document_chunks filtered by document_id, ordered by (page_number, chunk_index)
+# - pdf_documents filtered by library_id, ordered by upload_date DESC
+INDEXES = [
+    ("ix_conversations_lib_updated", "conversations", "(library_id, updated_at)"),
+    ("ix_chat_messages_conv_ts", "chat_messages", "(conversation_id, timestamp)"),
+    ("ix_chunks_doc_page_idx", "document_chunks", "(document_id, page_number, chunk_index)"),
+    ("ix_docs_lib_upload", "pdf_documents", "(library_id, upload_date)"),
+]
+
+def migrate_add_indexes():
+    """Create the composite indexes used by the history queries if missing."""
+    db_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '..', 'raglib.db')
+
+    if not os.path.exists(db_path):
+        print(f"Database file not found at {db_path}")
+        return
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        for name, table, columns in INDEXES:
+            print(f"Creating index {name} on {table}{columns}...")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} {columns}")
+        # Refresh planner statistics so the new indexes are actually chosen
+        cursor.execute("ANALYZE")
+        conn.commit()
+        print("Successfully created indexes.")
+
+    except Exception as e:
+        print(f"Error during migration: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    migrate_add_indexes()
@@ -0,0 +1,37 @@
+import sqlite3
+import os
+
+def migrate_add_token_count():
+    """Add token_count column to document_chunks table if it doesn't exist."""
+    db_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '..', 'raglib.db')
+
+    if not os.path.exists(db_path):
+        print(f"Database file not found at {db_path}")
+        return
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # Check if token_count column already exists
+        cursor.execute("PRAGMA table_info(document_chunks)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        if 'token_count' not in columns:
+            print("Adding token_count column to document_chunks table...")
+            cursor.execute("ALTER TABLE document_chunks ADD COLUMN token_count INTEGER")
+            # Backfill with the same 1 token ~= 4 characters estimate used at ingest
+            cursor.execute("UPDATE document_chunks SET token_count = MAX(1, LENGTH(content) / 4)")
+            conn.commit()
+            print("Successfully added token_count column to document_chunks table.")
+        else:
+            print("Token_count column already exists in document_chunks table.")
+
+    except Exception as e:
+        print(f"Error during migration: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    migrate_add_token_count()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime, ForeignKey, Integer, Text, Table
+from sqlalchemy import Column, String, DateTime, ForeignKey, Integer, Text, Table, Index
 from sqlalchemy.orm import relationship, declarative_base
 from sqlalchemy.dialects.sqlite import BLOB
 from sqlalchemy.types import JSON
@@ -22,6 +22,9 @@ class Library(Base):
 
 class PDFDocument(Base):
     __tablename__ = 'pdf_documents'
+    __table_args__ = (
+        Index('ix_docs_lib_upload', 'library_id', 'upload_date'),
+    )
     id = Column(String, primary_key=True, default=generate_uuid)
     name = Column(String, nullable=False)
     upload_date = Column(DateTime, default=datetime.datetime.utcnow)
@@ -33,6 +36,9 @@ class PDFDocument(Base):
 
 class DocumentChunk(Base):
     __tablename__ = 'document_chunks'
+    __table_args__ = (
+        Index('ix_chunks_doc_page_idx', 'document_id', 'page_number', 'chunk_index'),
+    )
     id = Column(String, primary_key=True, default=generate_uuid)
     content = Column(Text, nullable=False)
     page_number = Column(Integer)
@@ -40,10 +46,14 @@ class DocumentChunk(Base):
     document_id = Column(String, ForeignKey('pdf_documents.id'))
     document = relationship('PDFDocument', back_populates='chunks')
     chunk_metadata = Column(JSON, nullable=True)  # Flexible metadata for chunk (chapter, section, heading, etc.)
+    token_count = Column(Integer, nullable=True)  # Estimated tokens, computed once at ingest
     # Embeddings will be stored in vector store, not DB
 
 class Conversation(Base):
     __tablename__ = 'conversations'
+    __table_args__ = (
+        Index('ix_conversations_lib_updated', 'library_id', 'updated_at'),
+    )
     id = Column(String, primary_key=True, default=generate_uuid)
     library_id = Column(String, ForeignKey('libraries.id'))
     title = Column(String, nullable=False)
@@ -54,6 +64,9 @@ class Conversation(Base):
 
 class ChatMessage(Base):
     __tablename__ = 'chat_messages'
+    __table_args__ = (
+        Index('ix_chat_messages_conv_ts', 'conversation_id', 'timestamp'),
+    )
     id = Column(String, primary_key=True, default=generate_uuid)
     conversation_id = Column(String, ForeignKey('conversations.id'))
     content = Column(Text, nullable=False)
@@ -29,9 +29,15 @@ app.include_router(debug_router)
 
 @app.on_event("startup")
 async def startup_event():
-    """Rebuild FAISS index on startup if it's empty"""
+    """Raise the sync-handler thread cap and rebuild FAISS index if empty"""
     from app.db.session import SessionLocal
-    
+    import anyio
+
+    # The plain `def` DB endpoints run in anyio's worker pool, which caps at
+    # 40 threads by default and becomes the concurrency ceiling for the
+    # read-heavy routes. The DB pool (20+40 overflow) is sized to match.
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 100
+
     # Check if index is empty
     stats = vector_store.get_stats()
     if stats["total_embeddings"] == 0:
@@ -44,6 +50,12 @@ async def startup_event():
     else:
         print(f"[INFO] FAISS index loaded with {stats['total_embeddings']} embeddings")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close the shared LLM HTTP client"""
+    from app.api.chat import close_llm_client
+    await close_llm_client()
+
 @app.get("/")
 async def root():
     return {"message": "RAG Library API is running"}
@@ -1,9 +1,130 @@
 from sentence_transformers import SentenceTransformer
 from typing import List
+from collections import OrderedDict
+import hashlib
+import numpy as np
+import queue
+import threading
+import time
+import torch
 
 # You can use a small model for local testing
 MODEL_NAME = "all-MiniLM-L6-v2"
-model = SentenceTransformer(MODEL_NAME)
 
-def embed_texts(texts: List[str]) -> List[List[float]]:
-    return model.encode(texts, show_progress_bar=False).tolist()
+# Prefer the GPU with fp16 weights: MiniLM tolerates half precision with
+# negligible recall loss and roughly doubles encode throughput. Outputs stay
+# float32 (encode converts before normalization), so FAISS sees no change.
+_device = "cuda" if torch.cuda.is_available() else "cpu"
+model = SentenceTransformer(MODEL_NAME, device=_device)
+if _device == "cuda":
+    try:
+        model = model.half()
+    except (RuntimeError, torch.cuda.OutOfMemoryError) as e:
+        print(f"[WARNING] fp16 conversion failed ({e}); keeping fp32 weights")
+
+def _encode_texts(texts: List[str], batch_size: int = 64) -> np.ndarray:
+    """Run the model forward pass. Only the batcher thread calls this, so the
+    encoder never runs concurrently with itself."""
+    return model.encode(
+        texts,
+        batch_size=batch_size,
+        show_progress_bar=False,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+    )
+
+# Concurrent uploads each arrive with a handful of chunks; encoding them
+# separately pays the model-forward fixed cost per request. A single batcher
+# thread drains the queue with a short coalescing window so simultaneous
+# requests share one encode call. (Upload handlers run in FastAPI's
+# threadpool, so this is the threading equivalent of an asyncio gather.)
+_COALESCE_WINDOW_S = 0.02
+
+class _PendingEncode:
+    __slots__ = ("texts", "batch_size", "event", "result", "error")
+
+    def __init__(self, texts: List[str], batch_size: int):
+        self.texts = texts
+        self.batch_size = batch_size
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+_encode_queue: "queue.Queue[_PendingEncode]" = queue.Queue()
+
+def _batcher_loop():
+    while True:
+        pending = [_encode_queue.get()]
+        deadline = time.monotonic() + _COALESCE_WINDOW_S
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(_encode_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            # Coalesced callers may request different batch sizes; the
+            # largest one wins since it only bounds the per-forward chunk.
+            embeddings = _encode_texts(
+                [t for p in pending for t in p.texts],
+                batch_size=max(p.batch_size for p in pending),
+            )
+            offset = 0
+            for p in pending:
+                p.result = embeddings[offset:offset + len(p.texts)]
+                offset += len(p.texts)
+        except Exception as e:
+            for p in pending:
+                p.error = e
+        for p in pending:
+            p.event.set()
+
+_batcher = threading.Thread(target=_batcher_loop, daemon=True, name="embed-batcher")
+_batcher.start()
+
+# Re-ingesting an updated PDF re-embeds mostly unchanged chunks (boilerplate
+# pages, ToC, copyright). A bounded content-hash LRU lets those skip the
+# encoder entirely.
+_EMBED_CACHE_MAX = 100_000
+_embed_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+_embed_cache_lock = threading.Lock()
+
+def embed_texts(texts: List[str], batch_size: int = 64) -> np.ndarray:
+    """Encode texts into L2-normalized float32 embeddings, one row per text.
+
+    Returns the numpy array directly so downstream FAISS inserts avoid the
+    list-of-lists round trip. Inputs are looked up in a content-hash cache
+    first; only the misses are funneled through the batcher thread, which
+    merges concurrent callers into one encode call.
+    """
+    if not texts:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    keys = [hashlib.blake2b(t.encode(), digest_size=16).digest() for t in texts]
+    results = [None] * len(texts)
+    miss_idx = []
+    with _embed_cache_lock:
+        for i, key in enumerate(keys):
+            vec = _embed_cache.get(key)
+            if vec is not None:
+                _embed_cache.move_to_end(key)
+                results[i] = vec
+            else:
+                miss_idx.append(i)
+
+    if miss_idx:
+        item = _PendingEncode([texts[i] for i in miss_idx], batch_size)
+        _encode_queue.put(item)
+        item.event.wait()
+        if item.error is not None:
+            raise item.error
+        with _embed_cache_lock:
+            for i, vec in zip(miss_idx, item.result):
+                results[i] = vec
+                _embed_cache[keys[i]] = vec
+                if len(_embed_cache) > _EMBED_CACHE_MAX:
+                    _embed_cache.popitem(last=False)
+
+    return np.vstack(results)
@@ -1,30 +1,107 @@
 import pdfplumber
 from typing import List, Tuple, Dict, Any
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import logging
+import numpy as np
+import os
 import re
+import threading
 import fitz  # PyMuPDF for better text extraction
 import pandas as pd
 from PIL import Image
 import pytesseract
 import io
 
+# tesserocr keeps the Tesseract engine in-process, avoiding the fork/exec of
+# the tesseract binary that pytesseract pays per page. Optional dependency.
+try:
+    from tesserocr import PyTessBaseAPI
+    _HAS_TESSEROCR = True
+except ImportError:
+    _HAS_TESSEROCR = False
+
+logger = logging.getLogger(__name__)
+
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 200
 
+# Page extraction is CPU-bound and independent per page; large documents are
+# split into page ranges and farmed out to worker processes (the GIL makes
+# threads useless for the pdfplumber/pytesseract path).
+PARSE_WORKERS = int(os.getenv("RAGLIB_PARSE_WORKERS", str(min(8, os.cpu_count() or 1))))
+PAGE_RANGE_SIZE = 50
+PARALLEL_PAGE_THRESHOLD = 24  # Below this, process startup costs more than it saves
+TABLE_LINE_THRESHOLD = 8  # Min ruling-line drawings before a page is worth a table pass
+
 def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    n = len(text)
+    if n == 0:
+        return []
+    # Find every space once with a vectorized scan (utf-32-le yields one
+    # uint32 per character, so positions line up with Python string indexes
+    # even for non-ASCII text). Each chunk boundary then becomes a binary
+    # search over the space positions instead of an O(chunk_size) rfind.
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    spaces = np.flatnonzero(codes == 0x20)
     chunks = []
     start = 0
-    while start < len(text):
-        end = min(start + chunk_size, len(text))
-        chunk = text[start:end]
-        if end < len(text):
-            last_space = chunk.rfind(' ')
-            if last_space > chunk_size * 0.7:
-                chunk = chunk[:last_space]
-        chunks.append(chunk.strip())
-        if end >= len(text):
+    while start < n:
+        end = min(start + chunk_size, n)
+        cut = end
+        if end < n:
+            # Last space before `end`, applying the same "keep at least 70%
+            # of the chunk" rule as the old rfind-based loop.
+            i = np.searchsorted(spaces, end) - 1
+            if i >= 0 and spaces[i] - start > chunk_size * 0.7:
+                cut = int(spaces[i])
+        chunk = text[start:cut].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= n:
             break
         start = end - overlap
-    return [c for c in chunks if c]
+    return chunks
+
+def _extract_pages_range(file_path: str, start: int, end: int) -> List[Tuple[int, str, List[Dict[str, Any]]]]:
+    """Extract text and tables for pages start..end (1-based, inclusive).
+
+    Runs in a worker process: each worker opens its own handles since page
+    objects are not picklable, but a range amortizes the open cost over many
+    pages. Returns (page_number, text, tables) tuples, skipping empty pages.
+    """
+    payloads = []
+    with pdfplumber.open(file_path) as pdf, fitz.open(file_path) as fdoc:
+        for page_num in range(start, end + 1):
+            fitz_page = fdoc[page_num - 1] if page_num <= len(fdoc) else None
+            extraction_result = enhanced_text_extraction(pdf.pages[page_num - 1], fitz_page)
+            if extraction_result["text"].strip():
+                payloads.append((page_num, extraction_result["text"], extraction_result["tables"]))
+    return payloads
+
+def _extract_all_pages(file_path: str) -> List[Tuple[int, str, List[Dict[str, Any]]]]:
+    """Extract every page of the document, in parallel for large PDFs."""
+    with fitz.open(file_path) as fdoc:
+        total_pages = len(fdoc)
+
+    if PARSE_WORKERS <= 1 or total_pages < PARALLEL_PAGE_THRESHOLD:
+        return _extract_pages_range(file_path, 1, total_pages)
+
+    ranges = [
+        (start, min(start + PAGE_RANGE_SIZE - 1, total_pages))
+        for start in range(1, total_pages + 1, PAGE_RANGE_SIZE)
+    ]
+    payloads = []
+    with ProcessPoolExecutor(max_workers=min(PARSE_WORKERS, len(ranges))) as executor:
+        # executor.map preserves submission order, so pages come back sorted.
+        for range_payloads in executor.map(
+            _extract_pages_range,
+            repeat(file_path),
+            (r[0] for r in ranges),
+            (r[1] for r in ranges),
+        ):
+            payloads.extend(range_payloads)
+    return payloads
 
 def parse_pdf_and_chunk(file_path: str, toc: list = None) -> List[Tuple[str, int, int, dict]]:
     """
@@ -35,65 +112,59 @@ def parse_pdf_and_chunk(file_path: str, toc: list = None) -> List[Tuple[str, int
     toc = toc or []
     toc_sorted = sorted(toc, key=lambda x: x['page']) if toc else []
     heading_pattern = re.compile(r"^(CHAPTER|SECTION|[A-Z][A-Z\s\d\-:]{5,})$")
-    
-    # Get total pages
-    with pdfplumber.open(file_path) as pdf:
-        total_pages = len(pdf.pages)
-    
-    for page_num in range(1, total_pages + 1):
-        # Use enhanced text extraction
-        extraction_result = enhanced_text_extraction(file_path, page_num)
-        text = extraction_result["text"]
-        tables = extraction_result["tables"]
-        
-        if not text.strip():
-            continue
-            
+
+    # Extraction (the expensive, CPU-bound part) is fanned out across
+    # processes; chunk assembly below stays single-threaded and cheap.
+    for page_num, text, tables in _extract_all_pages(file_path):
         lines = text.splitlines()
         chunk_lines = []
         chunk_index = 0
         last_heading = None
-        
+
         # Find closest ToC entry for this page
         toc_entry = None
         for entry in reversed(toc_sorted):
             if page_num >= entry['page']:
                 toc_entry = entry
                 break
-        
+
+        # Metadata that is invariant for the page is built once; per-chunk
+        # dicts copy it and add only the fields that vary.
+        page_meta = {
+            "toc_title": toc_entry['title'] if toc_entry else None,
+            "toc_page": toc_entry['page'] if toc_entry else None,
+        }
+        text_meta_base = {
+            **page_meta,
+            "has_tables": len(tables) > 0,
+            "table_count": len(tables),
+        }
+
         # Process text lines
         for line in lines:
-            # Heading detection
-            if heading_pattern.match(line.strip()):
+            # Heading detection: cheap prefilter first — headings start with
+            # an uppercase letter, so most lines never reach the regex.
+            s = line.strip()
+            if s and s[0].isupper() and heading_pattern.match(s):
                 # If there is an existing chunk, save it
                 if chunk_lines:
                     chunk_text = " ".join(chunk_lines).strip()
                     if chunk_text:
-                        metadata = {
-                            "toc_title": toc_entry['title'] if toc_entry else None,
-                            "toc_page": toc_entry['page'] if toc_entry else None,
-                            "heading": last_heading,
-                            "has_tables": len(tables) > 0,
-                            "table_count": len(tables)
-                        }
+                        metadata = text_meta_base.copy()
+                        metadata["heading"] = last_heading
                         results.append((chunk_text, page_num, chunk_index, metadata))
                         chunk_index += 1
                     chunk_lines = []
-                last_heading = line.strip()
+                last_heading = s
             chunk_lines.append(line)
-        
+
         # Save any remaining chunk
         chunk_text = " ".join(chunk_lines).strip()
         if chunk_text:
-            metadata = {
-                "toc_title": toc_entry['title'] if toc_entry else None,
-                "toc_page": toc_entry['page'] if toc_entry else None,
-                "heading": last_heading,
-                "has_tables": len(tables) > 0,
-                "table_count": len(tables)
-            }
+            metadata = text_meta_base.copy()
+            metadata["heading"] = last_heading
             results.append((chunk_text, page_num, chunk_index, metadata))
-        
+
         # Add table data as separate chunks if tables exist
         for table_idx, table in enumerate(tables):
             table_text = f"Table {table_idx + 1}:\n"
@@ -104,19 +175,18 @@ def parse_pdf_and_chunk(file_path: str, toc: list = None) -> List[Tuple[str, int
                 table_text += " | ".join(str(v) for v in row.values()) + "\n"
             if len(table.get("data", [])) > 5:
                 table_text += f"... and {len(table['data']) - 5} more rows"
-            
-            metadata = {
-                "toc_title": toc_entry['title'] if toc_entry else None,
-                "toc_page": toc_entry['page'] if toc_entry else None,
+
+            metadata = page_meta.copy()
+            metadata.update({
                 "heading": last_heading,
                 "is_table": True,
                 "table_index": table_idx,
                 "table_rows": table.get("rows", 0),
                 "table_columns": table.get("columns", 0)
-            }
+            })
             results.append((table_text, page_num, chunk_index, metadata))
             chunk_index += 1
-    
+
     return results
 
 def extract_toc_from_pdf(file_path: str, max_pages: int = 10) -> list:
@@ -137,15 +207,32 @@ def extract_toc_from_pdf(file_path: str, max_pages: int = 10) -> list:
                     toc.append({"title": title, "page": page_num})
     return toc
 
+# OCR configuration built once at import instead of per page.
+_OCR_WHITELIST = r'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789.,;:!?()[]{}"\'-_/\\ '
+_OCR_CONFIG = r'--oem 3 --psm 6 -c tessedit_char_whitelist=' + _OCR_WHITELIST
+
+_ocr_local = threading.local()
+
+def _get_tess_api():
+    """One PyTessBaseAPI per thread/worker, reused across pages."""
+    api = getattr(_ocr_local, "api", None)
+    if api is None:
+        api = PyTessBaseAPI(psm=6)
+        api.SetVariable("tessedit_char_whitelist", _OCR_WHITELIST)
+        _ocr_local.api = api
+    return api
+
 def extract_text_with_ocr(page_image: Image.Image) -> str:
     """Extract text from image using OCR when regular text extraction fails."""
     try:
-        # Configure OCR for better accuracy
-        custom_config = r'--oem 3 --psm 6 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789.,;:!?()[]{}"\'-_/\\ '
-        text = pytesseract.image_to_string(page_image, config=custom_config)
+        if _HAS_TESSEROCR:
+            api = _get_tess_api()
+            api.SetImage(page_image)
+            return api.GetUTF8Text().strip()
+        text = pytesseract.image_to_string(page_image, config=_OCR_CONFIG)
         return text.strip()
     except Exception as e:
-        print(f"[WARNING] OCR failed: {e}")
+        logger.warning("OCR failed: %s", e)
         return ""
 
 def extract_tables_from_page(page) -> List[Dict[str, Any]]:
@@ -171,48 +258,47 @@ def extract_tables_from_page(page) -> List[Dict[str, Any]]:
                     }
                     tables.append(table_data)
     except Exception as e:
-        print(f"[WARNING] Table extraction failed: {e}")
+        logger.warning("Table extraction failed: %s", e)
     
     return tables
 
-def enhanced_text_extraction(file_path: str, page_num: int) -> Dict[str, Any]:
-    """Enhanced text extraction using multiple methods."""
+def enhanced_text_extraction(pdf_page, fitz_page) -> Dict[str, Any]:
+    """Enhanced text extraction using multiple methods.
+
+    Operates on already-open pdfplumber and PyMuPDF page objects so the
+    document is parsed once per file rather than once per page.
+    """
     result = {
         "text": "",
         "tables": [],
         "images": [],
         "metadata": {}
     }
-    
+
     try:
-        # Method 1: Try pdfplumber first
-        with pdfplumber.open(file_path) as pdf:
-            if page_num <= len(pdf.pages):
-                page = pdf.pages[page_num - 1]
-                result["text"] = page.extract_text() or ""
-                result["tables"] = extract_tables_from_page(page)
-        
-        # Method 2: If text extraction failed, try PyMuPDF
+        # Method 1: PyMuPDF first — considerably faster than pdfplumber for
+        # raw text, which is all most pages need.
+        if fitz_page is not None:
+            result["text"] = fitz_page.get_text("text")
+
+        # Method 2: If that failed, fall back to pdfplumber
         if not result["text"].strip():
-            doc = fitz.open(file_path)
-            if page_num <= len(doc):
-                page = doc[page_num - 1]
-                result["text"] = page.get_text()
-            doc.close()
-        
+            result["text"] = pdf_page.extract_text() or ""
+
+        # Table extraction is the expensive pdfplumber pass; only run it when
+        # the page has enough ruling lines to plausibly contain a table.
+        if fitz_page is None or len(fitz_page.get_drawings()) >= TABLE_LINE_THRESHOLD:
+            result["tables"] = extract_tables_from_page(pdf_page)
+
         # Method 3: If still no text, try OCR
-        if not result["text"].strip():
-            doc = fitz.open(file_path)
-            if page_num <= len(doc):
-                page = doc[page_num - 1]
-                # Convert page to image
-                mat = fitz.Matrix(2, 2)  # Higher resolution for better OCR
-                pix = page.get_pixmap(matrix=mat)
-                img_data = pix.tobytes("png")
-                img = Image.open(io.BytesIO(img_data))
-                result["text"] = extract_text_with_ocr(img)
-            doc.close()
-        
+        if not result["text"].strip() and fitz_page is not None:
+            # Convert page to image
+            mat = fitz.Matrix(2, 2)  # Higher resolution for better OCR
+            pix = fitz_page.get_pixmap(matrix=mat)
+            img_data = pix.tobytes("png")
+            img = Image.open(io.BytesIO(img_data))
+            result["text"] = extract_text_with_ocr(img)
+
         # Extract metadata
         result["metadata"] = {
             "has_text": bool(result["text"].strip()),
@@ -220,9 +306,9 @@ def enhanced_text_extraction(file_path: str, page_num: int) -> Dict[str, Any]:
             "text_length": len(result["text"]),
             "table_count": len(result["tables"])
         }
-        
+
     except Exception as e:
-        print(f"[ERROR] Enhanced text extraction failed for page {page_num}: {e}")
+        logger.error("Enhanced text extraction failed for page %s: %s", pdf_page.page_number, e)
         result["text"] = ""
-    
+
     return result
@@ -1,111 +1,471 @@
+import atexit
 import faiss
 import numpy as np
-from typing import List, Tuple
+from typing import Dict, List, Tuple
+import logging
 import os
 import pickle
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Per-upload saves are debounced: the index is written at most once per
+# quiet period, or immediately once enough vectors are pending.
+SAVE_DEBOUNCE_S = 2.0
+SAVE_MAX_PENDING = 2048
+
+# Incoming embeddings are staged in a Python-side buffer and folded into the
+# FAISS shards once this many vectors accumulate (or before any search/save):
+# many small index.add() calls each trigger internal reallocation, while one
+# large add grows the index once.
+ADD_BATCH_VECTORS = 1024
+
+# "flat" keeps exact fp32 vectors; "sq8" stores them 8-bit scalar-quantized
+# (4x smaller, minimal recall loss on normalized MiniLM embeddings); "fp16"
+# halves the footprint with effectively no recall loss, for when sq8 proves
+# too aggressive; "hnsw" builds a graph index whose search cost grows with
+# log N instead of N, for large libraries where exhaustive scans dominate.
+# Switching type on an existing deployment requires an index rebuild.
+INDEX_TYPE = os.getenv("RAGLIB_INDEX_TYPE", "flat").lower()
+
+# HNSW knobs: neighbours per node, build-time and query-time search effort.
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# faiss-cpu >= 1.7.4 wheels dispatch to AVX2/AVX-512 distance kernels at
+# runtime (2-4x brute-force throughput at 384 dims); warn when running on a
+# generic build so slow searches are explainable.
+try:
+    _compile_options = faiss.get_compile_options()
+    if "AVX" not in _compile_options:
+        logger.warning("FAISS built without AVX SIMD kernels (%s); "
+                       "searches will be slower — install a recent faiss-cpu wheel",
+                       _compile_options.strip())
+except AttributeError:
+    pass
+
+# When a faiss-gpu build sees a device, shards are mirrored to GPU memory —
+# brute-force scans there are memory-bandwidth bound and orders of magnitude
+# faster than on CPU. CPU-only builds report zero GPUs and skip all of this.
+try:
+    _NUM_GPUS = faiss.get_num_gpus()
+except AttributeError:
+    _NUM_GPUS = 0
+_gpu_res = faiss.StandardGpuResources() if _NUM_GPUS > 0 else None
+
+# Shard metadata lives in one structured array per shard: row lookup after a
+# search is contiguous array indexing instead of chasing a Python tuple per
+# hit, and np.save/np.load round-trips beat pickling a list of tuples.
+# The document name rides along so retrieval never has to touch the
+# documents table; names longer than 128 chars are truncated for display.
+META_DTYPE = np.dtype([
+    ('lib', 'U36'), ('doc', 'U36'), ('name', 'U128'),
+    ('chunk', 'U36'), ('page', 'i4'), ('idx', 'i4'),
+])
 
 class VectorStore:
+    """Per-library FAISS shards.
+
+    Each library gets its own index, so a search touches only that library's
+    vectors instead of scanning the global corpus and discarding foreign hits
+    afterwards. Shards are persisted as one index file plus one metadata
+    .npy file per library.
+    """
+
     def __init__(self, dim: int = 384, index_path: str = "faiss_index.bin", meta_path: str = "faiss_meta.pkl"):
         self.index_path = index_path
         self.meta_path = meta_path
         self.dim = dim
-        
-        # Try to load existing index
-        if os.path.exists(index_path) and os.path.exists(meta_path):
+        self.indexes: Dict[str, faiss.Index] = {}
+        self.metas: Dict[str, np.ndarray] = {}
+        self._bulk_buffer = []  # (array, meta) deferred by bulk uploads until end_bulk()
+        self._pending_adds = []  # staged (array, meta) awaiting a batched index.add
+        self._pending_add_count = 0
+        self._save_lock = threading.RLock()
+        self._save_timer = None
+        self._pending_vectors = 0
+        self._dirty = False
+        atexit.register(self.flush)
+
+        for lib_id in self._discover_shards():
             try:
-                self.index = faiss.read_index(index_path)
-                with open(meta_path, 'rb') as f:
-                    self.embeddings = pickle.load(f)
-                print(f"[INFO] Loaded existing FAISS index with {len(self.embeddings)} embeddings")
+                self.metas[lib_id] = self._load_meta(lib_id)
+                self.indexes[lib_id] = self._maybe_gpu(faiss.read_index(self._shard_path(lib_id)))
             except Exception as e:
-                print(f"[WARNING] Failed to load existing index: {e}. Creating new index.")
-                self.index = faiss.IndexFlatL2(dim)
-                self.embeddings = []
-        else:
-            self.index = faiss.IndexFlatL2(dim)
-            self.embeddings = []
+                logger.warning("Failed to load shard for library %s: %s. Skipping.", lib_id, e)
+                self.metas.pop(lib_id, None)
+
+        if self.indexes:
+            logger.info("Loaded %s FAISS shards with %s embeddings", len(self.indexes), self._total_embeddings())
+        elif os.path.exists(meta_path):
+            self._load_legacy()
+
+    # --- paths / layout -------------------------------------------------
+
+    def _shard_path(self, library_id: str) -> str:
+        base, ext = os.path.splitext(self.index_path)
+        return f"{base}.{library_id}{ext}"
+
+    def _meta_path_for(self, library_id: str) -> str:
+        base, _ = os.path.splitext(self.meta_path)
+        return f"{base}.{library_id}.npy"
+
+    def _discover_shards(self) -> List[str]:
+        base, _ = os.path.splitext(self.meta_path)
+        directory = os.path.dirname(base) or "."
+        prefix = os.path.basename(base) + "."
+        if not os.path.isdir(directory):
+            return []
+        return [
+            name[len(prefix):-len(".npy")]
+            for name in os.listdir(directory)
+            if name.startswith(prefix) and name.endswith(".npy")
+        ]
+
+    def _load_meta(self, library_id: str) -> np.ndarray:
+        # Memory-map instead of reading eagerly: startup stays O(1) and rows
+        # are demand-paged on first access, so cold-start cost no longer
+        # grows with corpus size. The first append to a shard concatenates
+        # into a regular in-memory array, which is the hot case anyway.
+        arr = np.load(self._meta_path_for(library_id), mmap_mode='r')
+        if arr.dtype.names != META_DTYPE.names:
+            # Shard written before the document name joined the metadata:
+            # carry the shared fields over and leave the names empty;
+            # retrieval resolves those from the DB until the next rebuild.
+            upgraded = np.zeros(len(arr), dtype=META_DTYPE)
+            for field in arr.dtype.names:
+                upgraded[field] = arr[field]
+            return upgraded
+        return arr
+
+    def _load_legacy(self):
+        """Load the pre-shard pickle layouts and rewrite them in the current
+        one: either a dict of meta lists (early shard format) or a flat list
+        next to a single global index."""
+        try:
+            with open(self.meta_path, 'rb') as f:
+                stored = pickle.load(f)
+            if isinstance(stored, dict):
+                for lib_id, meta in stored.items():
+                    self.metas[lib_id] = np.array([self._widen_legacy(m) for m in meta], dtype=META_DTYPE)
+                    self.indexes[lib_id] = self._maybe_gpu(faiss.read_index(self._shard_path(lib_id)))
+                self._save_index()
+                logger.info("Converted %s pickled shards to npy metadata", len(self.indexes))
+            elif isinstance(stored, list) and os.path.exists(self.index_path):
+                self._migrate_legacy(faiss.read_index(self.index_path), stored)
+        except Exception as e:
+            logger.warning("Failed to load existing index: %s. Creating new index.", e)
+            self.indexes = {}
+            self.metas = {}
+
+    # --- index construction ---------------------------------------------
+
+    def _new_index(self):
+        if INDEX_TYPE == "sq8":
+            return faiss.IndexScalarQuantizer(self.dim, faiss.ScalarQuantizer.QT_8bit)
+        if INDEX_TYPE == "fp16":
+            return faiss.IndexScalarQuantizer(self.dim, faiss.ScalarQuantizer.QT_fp16)
+        if INDEX_TYPE == "hnsw":
+            index = faiss.IndexHNSWFlat(self.dim, HNSW_M)
+            index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+            return index
+        return faiss.IndexFlatL2(self.dim)
+
+    @staticmethod
+    def _maybe_gpu(index):
+        """Move an index to the GPU when one is available; some index types
+        (e.g. HNSW) have no GPU implementation and stay on CPU."""
+        if _NUM_GPUS > 0:
+            try:
+                return faiss.index_cpu_to_gpu(_gpu_res, 0, index)
+            except Exception as e:
+                logger.warning("Could not move index to GPU: %s", e)
+        return index
+
+    @staticmethod
+    def _to_cpu(index):
+        if _NUM_GPUS > 0:
+            try:
+                return faiss.index_gpu_to_cpu(index)
+            except Exception:
+                pass
+        return index
+
+    @staticmethod
+    def _widen_legacy(m):
+        """Map a pre-name 5-tuple (lib, doc, chunk, page, idx) onto the
+        current 6-field layout with an empty name."""
+        return (m[0], m[1], '', m[2], m[3], m[4]) if len(m) == 5 else tuple(m)
 
-    def add_embeddings(self, vectors: List[List[float]], meta: List[Tuple[str, str, str, int, int]]):
-        arr = np.array(vectors).astype('float32')
-        self.index.add(arr)
-        self.embeddings.extend(meta)
+    @staticmethod
+    def _train_if_needed(index, arr):
+        # Quantized indexes need a training pass before the first add; flat
+        # indexes report is_trained immediately.
+        if not index.is_trained:
+            index.train(arr)
+
+    def _total_embeddings(self) -> int:
+        return sum(len(meta) for meta in self.metas.values())
+
+    def _migrate_legacy(self, old_index, old_meta: list):
+        """Split the old single global index into per-library shards by
+        reconstructing each stored vector and routing it on meta[0]."""
+        logger.info("Migrating legacy FAISS index (%s embeddings) to per-library shards", len(old_meta))
+        by_lib: Dict[str, List[int]] = {}
+        for i, meta in enumerate(old_meta):
+            by_lib.setdefault(meta[0], []).append(i)
+        for lib_id, positions in by_lib.items():
+            arr = np.vstack([old_index.reconstruct(i) for i in positions]).astype('float32')
+            self._add_to_shard(lib_id, arr, [self._widen_legacy(old_meta[i]) for i in positions])
         self._save_index()
 
-    def search_embeddings(self, query_vector: List[float], top_k: int = 5):
+    # --- writes ----------------------------------------------------------
+
+    def _add_to_shard(self, library_id: str, arr, meta):
+        index = self.indexes.get(library_id)
+        if index is None:
+            index = self._maybe_gpu(self._new_index())
+            self.indexes[library_id] = index
+            self.metas[library_id] = np.empty(0, dtype=META_DTYPE)
+        self._train_if_needed(index, arr)
+        index.add(arr)
+        new_meta = meta if isinstance(meta, np.ndarray) else np.array(meta, dtype=META_DTYPE)
+        self.metas[library_id] = np.concatenate([self.metas[library_id], new_meta])
+
+    def _route_by_library(self, arr, meta):
+        """Group a (vectors, meta) batch by the library_id in meta[0] and add
+        each group to its shard. Uploads are single-library, so this is
+        normally one group."""
+        by_lib: Dict[str, List[int]] = {}
+        for i, m in enumerate(meta):
+            by_lib.setdefault(m[0], []).append(i)
+        for lib_id, positions in by_lib.items():
+            self._add_to_shard(lib_id, arr[positions], [tuple(meta[i]) for i in positions])
+
+    def end_bulk(self) -> int:
+        """Fold embeddings deferred by bulk uploads into the shards and
+        persist once. Returns the number of vectors added. Also runs from
+        flush(), so an abandoned bulk session cannot keep documents out of
+        the index past the next save or shutdown."""
+        with self._save_lock:
+            buffered, self._bulk_buffer = self._bulk_buffer, []
+            total = 0
+            for arr, meta in buffered:
+                self._route_by_library(arr, meta)
+                total += len(arr)
+            if buffered:
+                self._save_index()
+        return total
+
+    def remove_library(self, library_id: str):
+        """Drop a library's shard from memory and disk, for library
+        deletion and for purging shards of libraries gone from the DB."""
+        with self._save_lock:
+            self.indexes.pop(library_id, None)
+            self.metas.pop(library_id, None)
+            for path in (self._shard_path(library_id), self._meta_path_for(library_id)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _purge_stale_shards(self):
+        """Delete shard files whose library is absent from the current in-
+        memory set, so a restart cannot resurrect vectors a rebuild or a
+        library deletion removed."""
+        for lib_id in self._discover_shards():
+            if lib_id not in self.indexes:
+                logger.info("Removing stale shard for library %s", lib_id)
+                self.remove_library(lib_id)
+
+    def rename_document(self, library_id: str, doc_id: str, new_name: str):
+        """Rewrite the cached document name in a shard's metadata after a
+        rename, so retrieval keeps serving current names."""
+        meta = self.metas.get(library_id)
+        if meta is None or not len(meta):
+            return
+        rows = meta['doc'] == doc_id
+        if rows.any():
+            # mmap-loaded metadata is read-only; materialize before writing.
+            meta = np.array(meta)
+            meta['name'][rows] = new_name
+            self.metas[library_id] = meta
+            self._schedule_save(0)
+
+    def add_embeddings(self, vectors, meta: List[Tuple[str, str, str, str, int, int]], defer: bool = False):
+        arr = np.asarray(vectors, dtype='float32')
+        if defer:
+            # Bulk uploads opt in per call; other callers are unaffected, so
+            # a forgotten end_bulk() never stalls normal ingestion.
+            with self._save_lock:
+                self._bulk_buffer.append((arr, meta))
+            return
+        with self._save_lock:
+            self._pending_adds.append((arr, meta))
+            self._pending_add_count += len(arr)
+            if self._pending_add_count >= ADD_BATCH_VECTORS:
+                self._drain_pending()
+        self._schedule_save(len(arr))
+
+    def _drain_pending(self):
+        """Fold staged embeddings into the shards with one add per library.
+        Called once the staging buffer is full and before any search or
+        save, so readers always see a complete index."""
+        with self._save_lock:
+            staged, self._pending_adds = self._pending_adds, []
+            self._pending_add_count = 0
+            if not staged:
+                return
+            arr = np.vstack([a for a, _ in staged])
+            meta = [m for _, ms in staged for m in ms]
+            self._route_by_library(arr, meta)
+
+    # --- reads -----------------------------------------------------------
+
+    def search_embeddings(self, query_vector: List[float], top_k: int = 5, library_id: str = None):
+        self._drain_pending()
         arr = np.array([query_vector]).astype('float32')
-        D, I = self.index.search(arr, top_k)
-        results = []
-        for idx in I[0]:
-            if 0 <= idx < len(self.embeddings):
-                results.append(self.embeddings[idx])
-        return results
+        if library_id is not None:
+            shards = [library_id] if library_id in self.indexes else []
+        else:
+            shards = list(self.indexes)
+
+        # With a library_id this is a single shard search; without one the
+        # shards are merged by distance for the same global-top-k semantics.
+        hits = []
+        for lib_id in shards:
+            meta = self.metas[lib_id]
+            if not len(meta):
+                continue
+            D, I = self.indexes[lib_id].search(arr, min(top_k, len(meta)))
+            valid = (I[0] >= 0) & (I[0] < len(meta))
+            for dist, row in zip(D[0][valid], meta[I[0][valid]]):
+                hits.append((dist, row))
+        hits.sort(key=lambda h: h[0])
+        return [row for _, row in hits[:top_k]]
+
+    def _schedule_save(self, added: int):
+        """Debounce per-upload saves: mark the store dirty and write after a
+        quiet period, or immediately once enough vectors are pending. Bulk
+        paths still save eagerly since they already batch."""
+        with self._save_lock:
+            self._dirty = True
+            self._pending_vectors += added
+            if self._pending_vectors >= SAVE_MAX_PENDING:
+                self.flush()
+                return
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(SAVE_DEBOUNCE_S, self.flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def flush(self):
+        """Write out any pending changes (also registered via atexit).
+        Deferred bulk embeddings are folded in first so they are never lost
+        to an abandoned bulk session."""
+        with self._save_lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if self._bulk_buffer:
+                self.end_bulk()
+                return
+            if not self._dirty:
+                return
+            self._drain_pending()
+            self._dirty = False
+            self._pending_vectors = 0
+            self._write_shards()
 
     def _save_index(self):
-        """Save the FAISS index and metadata to disk"""
+        """Save the FAISS shards and metadata to disk immediately."""
+        with self._save_lock:
+            self._drain_pending()
+            self._dirty = False
+            self._pending_vectors = 0
+            self._write_shards()
+
+    def _write_shards(self):
         try:
-            faiss.write_index(self.index, self.index_path)
-            with open(self.meta_path, 'wb') as f:
-                pickle.dump(self.embeddings, f)
-            print(f"[INFO] Saved FAISS index with {len(self.embeddings)} embeddings")
+            for lib_id, index in self.indexes.items():
+                # Write-then-rename so a crash mid-write never leaves a
+                # truncated index or metadata file behind.
+                shard_path = self._shard_path(lib_id)
+                faiss.write_index(self._to_cpu(index), shard_path + ".tmp")
+                os.replace(shard_path + ".tmp", shard_path)
+                meta_path = self._meta_path_for(lib_id)
+                with open(meta_path + ".tmp", 'wb') as f:
+                    np.save(f, self.metas[lib_id])
+                os.replace(meta_path + ".tmp", meta_path)
+            logger.info("Saved %s FAISS shards with %s embeddings", len(self.indexes), self._total_embeddings())
         except Exception as e:
-            print(f"[ERROR] Failed to save FAISS index: {e}")
+            logger.error("Failed to save FAISS index: %s", e)
 
     def rebuild_from_database(self, db_session):
-        """Rebuild the index from the database"""
+        """Rebuild the shards from the database"""
         from app.rag.embedder import embed_texts
         from app.db import models
-        
-        print("[INFO] Rebuilding FAISS index from database...")
-        
-        # Clear existing index
-        self.index = faiss.IndexFlatL2(self.dim)
-        self.embeddings = []
-        
+
+        logger.info("Rebuilding FAISS index from database...")
+
+        # Clear existing shards; files for libraries no longer in the DB are
+        # deleted below once the rebuilt set is known, so a restart cannot
+        # resurrect their vectors.
+        self.indexes = {}
+        self.metas = {}
+
         # Get all chunks from database
         chunks = db_session.query(models.DocumentChunk).all()
         if not chunks:
-            print("[INFO] No chunks found in database")
+            logger.info("No chunks found in database")
+            self._purge_stale_shards()
             return
-        
-        # Group chunks by document for efficient embedding
-        doc_chunks = {}
-        for chunk in chunks:
-            if chunk.document_id not in doc_chunks:
-                doc_chunks[chunk.document_id] = []
-            doc_chunks[chunk.document_id].append(chunk)
-        
+
+        # Resolve every chunk's library in one IN() query instead of one
+        # PDFDocument lookup per document.
+        doc_ids = list({chunk.document_id for chunk in chunks})
+        docs = {
+            doc.id: doc
+            for doc in db_session.query(models.PDFDocument)
+            .filter(models.PDFDocument.id.in_(doc_ids))
+        }
+        chunks = [c for c in chunks if c.document_id in docs]
+
+        # Embed in fixed-size mini-batches across document boundaries: the
+        # model's throughput comes from batch size, and per-document batches
+        # leave it mostly idle on short documents.
+        embedding_parts = []
+        meta = []
+        for i in range(0, len(chunks), 256):
+            batch = chunks[i:i + 256]
+            embedding_parts.append(embed_texts([c.content for c in batch]))
+            for chunk in batch:
+                doc = docs[chunk.document_id]
+                # page/index default to 0 for the structured array; they are
+                # informational only and nullable in the DB
+                meta.append((doc.library_id, doc.id, doc.name, chunk.id,
+                             chunk.page_number or 0, chunk.chunk_index or 0))
+
         total_embeddings = 0
-        for doc_id, doc_chunk_list in doc_chunks.items():
-            # Get document and library info
-            doc = db_session.query(models.PDFDocument).filter(models.PDFDocument.id == doc_id).first()
-            if not doc:
-                continue
-                
-            # Prepare texts and metadata
-            texts = [chunk.content for chunk in doc_chunk_list]
-            embeddings = embed_texts(texts)
-            
-            # Prepare metadata
-            meta = []
-            for chunk, emb in zip(doc_chunk_list, embeddings):
-                meta.append((doc.library_id, doc_id, chunk.id, chunk.page_number, chunk.chunk_index))
-            
-            # Add to index
-            if embeddings:
-                arr = np.array(embeddings).astype('float32')
-                self.index.add(arr)
-                self.embeddings.extend(meta)
-                total_embeddings += len(embeddings)
-        
-        # Save the rebuilt index
+        if embedding_parts:
+            arr = np.ascontiguousarray(np.vstack(embedding_parts), dtype='float32')
+            self._route_by_library(arr, meta)
+            total_embeddings = len(arr)
+
+        # Save the rebuilt index, then drop shard files the rebuild did not
+        # produce (deleted libraries).
         self._save_index()
-        print(f"[INFO] Rebuilt FAISS index with {total_embeddings} embeddings from {len(doc_chunks)} documents")
+        self._purge_stale_shards()
+        logger.info("Rebuilt FAISS index with %s embeddings from %s documents", total_embeddings, len(docs))
 
     def get_stats(self):
         """Get statistics about the vector store"""
         return {
-            "total_embeddings": len(self.embeddings),
-            "index_size": self.index.ntotal if hasattr(self.index, 'ntotal') else 0,
+            "total_embeddings": self._total_embeddings(),
+            "index_size": sum(index.ntotal for index in self.indexes.values()),
+            "libraries": len(self.indexes),
             "dimension": self.dim
         }
 
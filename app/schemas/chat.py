@@ -29,6 +29,7 @@ class ChatRequest(BaseModel):
     metadata_filter: Optional[dict] = None
     document_ids: Optional[List[str]] = None  # Filter by specific document IDs
     response_length: Optional[str] = "medium"  # "short", "medium", "long"
+    stream: Optional[bool] = False  # Stream the answer as Server-Sent Events
 
 class ChatResponse(BaseModel):
     answer: str
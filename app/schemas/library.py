@@ -20,6 +20,15 @@ class PDFDocumentSchema(BaseModel):
     class Config:
         from_attributes = True
 
+class PDFDocumentMetaSchema(BaseModel):
+    """Document metadata without chunk bodies, for list views."""
+    id: str
+    name: str
+    upload_date: datetime
+
+    class Config:
+        from_attributes = True
+
 class LibraryBase(BaseModel):
     name: str
     description: Optional[str] = None
@@ -35,3 +44,12 @@ class LibrarySchema(LibraryBase):
 
     class Config:
         from_attributes = True
+
+class LibraryListSchema(LibraryBase):
+    """Library with document metadata only; chunks are fetched lazily."""
+    id: str
+    created_at: datetime
+    documents: List[PDFDocumentMetaSchema] = []
+
+    class Config:
+        from_attributes = True
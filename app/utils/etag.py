@@ -0,0 +1,13 @@
+import hashlib
+from uuid import uuid4
+
+# Some ETag inputs (the answer-cache mutation generations) live only in
+# process memory and reset on restart; mixing a per-boot nonce into every
+# ETag means a restart invalidates outstanding ones rather than risking a
+# false 304 match against pre-restart state.
+_BOOT_NONCE = uuid4().hex
+
+def make_etag(*parts) -> str:
+    """Build a strong ETag from cheap change markers (counts, max timestamps)."""
+    raw = "|".join((_BOOT_NONCE, *(str(p) for p in parts)))
+    return '"' + hashlib.blake2b(raw.encode(), digest_size=8).hexdigest() + '"'